@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Computes the area of the CAMS requests from the Sentinel-2 tiles or the sites to process,
+# so that only the region of interest is downloaded instead of the whole globe
+# Written for download_CAMS_daily.py, CESBIO
+#
+import math
+import os
+import os.path
+import sys
+
+BANDES_MGRS = "CDEFGHJKLMNPQRSTUVWX"
+# letters of the columns of the 100km squares, in zones 1, 2, 3 modulo 3, and of the rows
+COLONNES_MGRS = ["ABCDEFGH", "JKLMNPQR", "STUVWXYZ"]
+LIGNES_MGRS = "ABCDEFGHJKLMNPQRSTUV"
+# Sentinel-2 tiles start at the upper left corner of their 100km square, and are 109.8km wide
+TAILLE_TUILE = 109800.
+
+
+def transformation_latlon(epsg):
+    """Returns the transformation from the projection epsg to WGS84 longitudes and latitudes"""
+    from osgeo import osr
+    latlon = osr.SpatialReference()
+    latlon.SetWellKnownGeogCS("WGS84")
+    proj = osr.SpatialReference()
+    proj.ImportFromEPSG(epsg)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL >= 3 : (x, y) is (longitude, latitude) as with GDAL 2
+        latlon.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(proj, latlon), osr.CoordinateTransformation(latlon, proj)
+
+
+def tile_utm_corners(tile):
+    """Returns the EPSG code and the corners (ulx, uly, lrx, lry) of a Sentinel-2 tile, from its MGRS name"""
+    zone = int(tile[0:2])
+    bande = tile[2].upper()
+    epsg = (32600 if bande >= 'N' else 32700) + zone
+    x_min = (COLONNES_MGRS[(zone - 1) % 3].index(tile[3].upper()) + 1) * 100000.
+    # the rows are named modulo 2000km, shifted by 5 letters in the even zones
+    y_modulo = ((LIGNES_MGRS.index(tile[4].upper()) - (5 if zone % 2 == 0 else 0)) % 20) * 100000.
+
+    # the latitude band gives the multiple of 2000km, from the northing of its southern limit
+    lat_bande = -80 + 8 * BANDES_MGRS.index(bande)
+    (vers_latlon, vers_utm) = transformation_latlon(epsg)
+    y_bande = vers_utm.TransformPoint(-183 + 6 * zone, lat_bande, 0)[1]
+    y_min = y_modulo
+    while y_min + 100000 <= y_bande:
+        y_min += 2000000
+    return epsg, (x_min, y_min + 100000, x_min + TAILLE_TUILE, y_min + 100000 - TAILLE_TUILE)
+
+
+def tile_latlon_bbox(tile):
+    """Returns (lat_min, lon_min, lat_max, lon_max) of a Sentinel-2 tile, from its UTM footprint"""
+    (epsg, (ulx, uly, lrx, lry)) = tile_utm_corners(tile)
+    (vers_latlon, vers_utm) = transformation_latlon(epsg)
+    lon_centre = -183 + 6 * (epsg % 100)
+
+    # corners and middles of the edges, the edges of the tile are not straight in longitude and latitude
+    points = [vers_latlon.TransformPoint(x, y, 0)
+              for x in (ulx, (ulx + lrx) / 2., lrx) for y in (uly, (uly + lry) / 2., lry)]
+    # longitudes around the central meridian, whatever the wrapping of the transformation
+    lons = [lon_centre + (point[0] - lon_centre + 180) % 360 - 180 for point in points]
+    lats = [point[1] for point in points]
+    # in zones 1 and 60, a tile beyond the antimeridian is wrapped, a tile across it is cut at +/-180
+    if max(lons) < -180:
+        lons = [lon + 360 for lon in lons]
+    elif min(lons) > 180:
+        lons = [lon - 360 for lon in lons]
+    return min(lats), max(-180., min(lons)), max(lats), min(180., max(lons))
+
+
+def site_latlon_bbox(fic_site):
+    """Returns (lat_min, lon_min, lat_max, lon_max) of the tiles of a site file of prepare_mnt"""
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'prepare_mnt'))
+    from lib_mnt import lire_fichier_site
+
+    site = lire_fichier_site(fic_site)
+    (transform, vers_utm) = transformation_latlon(site.EPSG_out)
+
+    # corners of the site, as in tuilage_mnt_eau_S2.py
+    ulx_site = site.orig_x + site.tx_min * site.pas_x
+    uly_site = site.orig_y + site.ty_max * site.pas_y
+    lrx_site = site.orig_x + (site.tx_max + 1) * site.pas_x + site.marge
+    lry_site = site.orig_y + (site.ty_min - 1) * site.pas_y - site.marge
+
+    coins = [transform.TransformPoint(x, y, 0) for x in (ulx_site, lrx_site) for y in (uly_site, lry_site)]
+    lons = [coin[0] for coin in coins]
+    lats = [coin[1] for coin in coins]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+def cams_area(bboxes, marge=2.5, pas=1.25):
+    """Returns the area of a MARS request ("North/West/South/East") which contains all the bounding boxes
+    enlarged by marge degrees, with limits aligned on the grid of the CAMS files"""
+    lat_min = min([bbox[0] for bbox in bboxes]) - marge
+    lon_min = min([bbox[1] for bbox in bboxes]) - marge
+    lat_max = max([bbox[2] for bbox in bboxes]) + marge
+    lon_max = max([bbox[3] for bbox in bboxes]) + marge
+
+    nord = min(90., math.ceil(lat_max / pas) * pas)
+    sud = max(-90., math.floor(lat_min / pas) * pas)
+    # MARS expects longitudes in [-180, 180]
+    ouest = max(-180., math.floor(lon_min / pas) * pas)
+    est = min(180., math.ceil(lon_max / pas) * pas)
+    if est - ouest >= 360:
+        ouest, est = -180., 180.
+    return "%g/%g/%g/%g" % (nord, ouest, sud, est)
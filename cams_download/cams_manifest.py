@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Manifest of the CAMS files already downloaded and converted, used by download_CAMS_daily.py -i
+# to request only the files which are missing or corrupted
+# Written for download_CAMS_daily.py, CESBIO
+#
+import hashlib
+import json
+import os
+import os.path
+import re
+import tarfile
+import threading
+
+MANIFEST = "cams_manifest.json"
+DBL_PATTERN = re.compile(r"^S2__TEST_EXO_CAMS_(\d{8})T(\d{6})_\d{8}T\d{6}\.DBL$")
+
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for bloc in iter(lambda: f.read(1048576), b""):
+            md5.update(bloc)
+    return md5.hexdigest()
+
+
+def signature(path, verify):
+    entry = {"size": os.path.getsize(path)}
+    if verify:
+        entry["md5"] = md5_file(path)
+    return entry
+
+
+def check_dbl(dbl):
+    # a DBL archive is valid if it can be read until the end, with the three netcdf files
+    try:
+        with tarfile.open(dbl, "r:bz2") as tar:
+            noms = [membre.name for membre in tar.getmembers() if membre.isfile()]
+    except (tarfile.TarError, IOError, EOFError):
+        return False
+    return len([nom for nom in noms if nom.endswith(".nc")]) == 3
+
+
+class CAMSManifest(object):
+    """Size (and md5 if verify) of the DBL/HDR files of archive_dir, per date, and of the downloaded netcdf files"""
+
+    def __init__(self, archive_dir, verify=False):
+        self.archive_dir = archive_dir
+        self.fichier = os.path.join(archive_dir, MANIFEST)
+        self.verify = verify
+        # the manifest is updated by the conversion threads
+        self.lock = threading.Lock()
+        self.contenu = {"archive": {}, "netcdf": {}}
+        if os.path.exists(self.fichier):
+            try:
+                with open(self.fichier) as f:
+                    self.contenu = json.load(f)
+            except ValueError:
+                print 'CAMS manifest %s is corrupted, all the files will be checked again' % self.fichier
+
+        # DBL files converted before the manifest existed, the most recent production first
+        self.dbl_par_date = {}
+        for nom in sorted(os.listdir(archive_dir), reverse=True):
+            m = DBL_PATTERN.match(nom)
+            if m is not None:
+                self.dbl_par_date.setdefault(m.group(1) + "UTC" + m.group(2), nom)
+
+    def save(self):
+        fichier_tmp = self.fichier + ".tmp"
+        with open(fichier_tmp, "w") as f:
+            json.dump(self.contenu, f, indent=1, sort_keys=True)
+        os.rename(fichier_tmp, self.fichier)
+
+    def _valide(self, path, entry):
+        if entry is None or not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        if self.verify and "md5" in entry:
+            return md5_file(path) == entry["md5"]
+        return True
+
+    def archive_ok(self, date_nom):
+        """Tells if the DBL/HDR files of a date (yyyymmddUTChhmmss) exist and are valid"""
+        entry = self.contenu["archive"].get(date_nom)
+        if entry is not None:
+            dbl = os.path.join(self.archive_dir, entry["DBL"]["name"])
+            hdr = os.path.join(self.archive_dir, entry["HDR"]["name"])
+            if self._valide(dbl, entry["DBL"]) and self._valide(hdr, entry["HDR"]):
+                return True
+            with self.lock:
+                self.contenu["archive"].pop(date_nom, None)
+
+        nom = self.dbl_par_date.get(date_nom)
+        if nom is None:
+            return False
+        dbl = os.path.join(self.archive_dir, nom)
+        hdr = dbl[:-len(".DBL")] + ".HDR"
+        if not os.path.exists(hdr) or not check_dbl(dbl):
+            return False
+        self.record_archive(date_nom, dbl, hdr)
+        return True
+
+    def record_archive(self, date_nom, dbl, hdr):
+        entry = {}
+        for (cle, path) in (("DBL", dbl), ("HDR", hdr)):
+            entry[cle] = signature(path, self.verify)
+            entry[cle]["name"] = os.path.basename(path)
+        with self.lock:
+            self.contenu["archive"][date_nom] = entry
+            self.save()
+
+    def netcdf_ok(self, path):
+        """Tells if a netcdf file was completely downloaded, and was not modified since"""
+        return self._valide(path, self.contenu["netcdf"].get(os.path.basename(path)))
+
+    def record_netcdf(self, path):
+        entry = signature(path, self.verify)
+        with self.lock:
+            self.contenu["netcdf"][os.path.basename(path)] = entry
+            self.save()
+
+    def remove_netcdf(self, path):
+        with self.lock:
+            if self.contenu["netcdf"].pop(os.path.basename(path), None) is not None:
+                self.save()
@@ -9,12 +9,23 @@
 import os
 from ecmwfapi import ECMWFDataServer
 from convert_to_exo import process_one_file
+from split_cams import split_cams_file
+from cams_area import cams_area, site_latlon_bbox, tile_latlon_bbox
+from cams_manifest import CAMSManifest
 import datetime
 import timeit
 import optparse
+import Queue
 import sys
+import threading
 
 server = ECMWFDataServer()
+#manifeste des fichiers telecharges et convertis (cams_manifest.json dans archive_dir), avec -i seulement
+manifest = None
+#conversions en DBL/HDR, faites pendant les telechargements
+conversions = None
+#zone des requetes, "G" pour le globe entier, ou "Nord/Ouest/Sud/Est" (options -t et -s)
+area = "G"
 ###########################################################################
 class OptionParser (optparse.OptionParser):
  
@@ -26,94 +37,273 @@ class OptionParser (optparse.OptionParser):
           self.error("%s option not supplied" % option)
 
 ###########################################################################
+#Parametres des requetes, par type de fichier
+#Surface  : AOT a 550nm pour BC, SS, SU, DU, OM
+#           208.210/209.210/210.210/211.210/212.210 : AOT at 550nm for BC, SS, OM, SU, DU
+#Pressure : Relative Humidity RH
+#Model    : les mixing ratios : 3 bins DUST, 3 bins SEASALT, ORGANICMATTER hydrophile et hydrophobe, BLACKCARBON hydrophile et hydrophobe, et SULFATE.
+PARAM_REQUESTS = {
+    'surface'  : ('AOT', {'levtype' : "SFC",
+                          'param'   : "208.210/209.210/210.210/211.210/212.210"}),
+    'pressure' : ('RH',  {'levtype' : "pl",
+                          "levelist": "1/2/3/5/7/10/20/30/50/70/100/150/200/250/300/400/500/600/700/850/925/1000",
+                          'param'   : "157.128"}),
+    'model'    : ('MR',  {'levtype' : "ml",
+                          "levelist": "1/to/60",
+                          'param'   : "1.210/2.210/3.210/4.210/5.210/6.210/7.210/8.210/9.210/10.210/11.210"}),
+}
+
+
+def cams_request(type_fichier,date,time,step,target):
+        request = {
+            'stream'  : "oper",
+            'class'   : "mc",
+            'dataset' : "cams_nrealtime",
+            'expver'  : "0001",
+            'step'    : step,
+            'date'    : date,
+            'time'    : time,
+            'type'    : "fc",
+            'area'    : area,
+            'grid'    : "1.25/1.25",
+            'format'  : "netcdf",
+            'target'  : target
+            }
+        request.update(PARAM_REQUESTS[type_fichier][1])
+        return request
+
+
+def cams_requests(dt,file_type,time,step,path_out):
+        """Returns the names of the AOT, RH and MR files of a date and forecast time, and the requests to download them"""
+
+        date_courante = str(dt.year)+'%02d'%(dt.month)+'%02d'%(dt.day)
+        noms = {}
+        requests = []
+        for type_fichier in ('surface', 'pressure', 'model'):
+            prefixe = PARAM_REQUESTS[type_fichier][0]
+            noms[prefixe] = path_out + "/CAMS_" + prefixe + "_" + date_courante + 'UTC' + str(int(time)+int(step)).zfill(2) + '0000.nc'
+            if file_type[type_fichier] == True:
+                requests.append(cams_request(type_fichier,date_courante,time,step,noms[prefixe]))
+        return (noms['AOT'], noms['RH'], noms['MR']), requests
+
+
+def batch_requests(dt_debut,dt_fin,file_type,time,step,path_out):
+        """Returns the requests which download all the dates and times from dt_debut to dt_fin in one file per type
+        the files are then split by date with split_cams_file"""
+
+        debut = dt_debut.strftime('%Y%m%d')
+        fin = dt_fin.strftime('%Y%m%d')
+        requests = []
+        for type_fichier in ('surface', 'pressure', 'model'):
+            if file_type[type_fichier] == True:
+                prefixe = PARAM_REQUESTS[type_fichier][0]
+                target = path_out + "/CAMS_" + prefixe + "_" + debut + "_" + fin + ".nc"
+                requests.append(cams_request(type_fichier,debut + "/to/" + fin,"/".join(time),step,target))
+        return requests
+
+
 def download_files(dt,file_type,time,step,path_out):
 
+        (nom_AOT, nom_RH, nom_MR), requests = cams_requests(dt,file_type,time,step,path_out)
+        print '\nCurrent_date =',dt.strftime('%Y%m%d')
 
-	date_courante = str(dt.year)+'%02d'%(dt.month)+'%02d'%(dt.day)
-        print '\nCurrent_date =',date_courante
-
-        if file_type['surface'] == True:
-            #=================
-            #     Surface
-            # Recupere AOT a 550nm pour BC, SS, SU, DU, OM
-            #=================
-            nom_AOT = path_out + "/CAMS_AOT_" + date_courante + 'UTC' + str(int(time)+int(step)).zfill(2) + '0000.nc'
-            print 'Nom fichier de sortie AOT :',nom_AOT
-
-            server.retrieve({
-                'stream'  : "oper",
-                'class'   : "mc",
-                'dataset' : "cams_nrealtime",
-                'expver'  : '0001',
-                'step'    : step,
-                'levtype' : "SFC",
-                'date'    : date_courante,
-                'time'    : time,
-                'type'    : "fc",
-                'param'   : "208.210/209.210/210.210/211.210/212.210",
-                'area'    : "G",
-                'grid'    : "1.25/1.25",
-                'format'  : "netcdf",
-                'target'  : nom_AOT
-                })
-            #208.210/209.210/210.210/211.210/212.210 : AOT at 550nm for BC, SS, OM, SU, DU
-
-        if file_type['pressure'] == True:
-            #=========================
-            #     Pressure levels
-            #
-            # Recupere Relative Humidity RH
-            #=========================
-            nom_RH = path_out + "/CAMS_RH_" + date_courante + 'UTC' + str(int(time)+int(step)).zfill(2) + '0000.nc'
-            print 'Nom fichier de sortie RH :',nom_RH
-
-            server.retrieve({
-                  'stream'  : "oper",
-                  'class'   : "mc",
-                  'dataset' : "cams_nrealtime",
-                  'expver'  : "0001",
-                  'step'    : step,
-                  'levtype' : "pl",
-                  "levelist": "1/2/3/5/7/10/20/30/50/70/100/150/200/250/300/400/500/600/700/850/925/1000",
-                  'date'    : date_courante,
-                  'time'    : time,
-                  'type'    : "fc",
-                  'param'   : "157.128",
-                  'area'    : "G",
-                  'grid'    : "1.25/1.25",
-                  'format'  : "netcdf",
-                  'target'  : nom_RH
-                  })
-
-        if file_type['model'] == True:
-            #=========================
-            #     Model levels
-            #
-            # Recupere les mixing ratios : 3 bins DUST, 3 bins SEASALT, ORGANICMATTER hydrophile et hydrophobe, BLACKCARBON hydrophile et hydrophobe, et SULFATE.
-            #=========================
-            nom_MR = path_out + "/CAMS_MR_" + date_courante + 'UTC' + str(int(time)+int(step)).zfill(2) + '0000.nc'
-            print 'Nom fichier de sortie mixRatios :',nom_MR
-
-            server.retrieve({
-                'stream'  : "oper",
-                'class'   : "mc",
-                'dataset' : "cams_nrealtime",
-                'expver'  : "0001",
-                'step'    : step,
-                'levtype' : "ml",
-                "levelist": "1/to/60",
-                'date'    : date_courante,
-                'time'    : time,
-                'type'    : "fc",
-                'param'   : "1.210/2.210/3.210/4.210/5.210/6.210/7.210/8.210/9.210/10.210/11.210",
-                'area'    : "G",
-                'grid'    : "1.25/1.25",
-                'format'  : "netcdf",
-                'target'  : nom_MR
-                })
+        for request in requests:
+            print 'Nom fichier de sortie :',request['target']
+            server.retrieve(request)
+            if manifest is not None:
+                manifest.record_netcdf(request['target'])
         return nom_AOT, nom_RH, nom_MR
 
 
+def date_netcdf(nom):
+        #date yyyymmddUTChhmmss d'un fichier CAMS_AOT_yyyymmddUTChhmmss.nc
+        return os.path.basename(nom).split('_')[2][:-len('.nc')]
+
+
+def convert_files(nom_AOT,nom_RH,nom_MR,path_out,archive_dir,keep):
+        #conversion to MAJA DBL/HDR format
+        dbl, hdr = process_one_file(nom_AOT, nom_MR, nom_RH, path_out, archive_dir)
+        if manifest is not None:
+            manifest.record_archive(date_netcdf(nom_AOT), dbl, hdr)
+        if not(keep):
+            for nom in (nom_AOT, nom_MR, nom_RH):
+                os.remove(nom)
+                if manifest is not None:
+                    manifest.remove_netcdf(nom)
+
+
+class ConversionThreads(object):
+        """Converts the files of the dates put in a bounded queue, on nb_threads threads, while the downloads go on
+        with nb_threads = 0, the files are converted as soon as they are put in the queue"""
+
+        def __init__(self,path_out,archive_dir,keep,nb_threads,taille_queue):
+            self.path_out = path_out
+            self.archive_dir = archive_dir
+            self.keep = keep
+            self.queue = Queue.Queue(taille_queue)
+            self.echecs = []
+            self.threads = []
+            for i in range(nb_threads):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        def _convert(self,nom_AOT,nom_RH,nom_MR):
+            try:
+                convert_files(nom_AOT,nom_RH,nom_MR,self.path_out,self.archive_dir,self.keep)
+            except Exception as e:
+                print 'Conversion of %s failed : %s' % (date_netcdf(nom_AOT), e)
+                self.echecs.append(nom_AOT)
+
+        def _run(self):
+            while True:
+                noms = self.queue.get()
+                if noms is None:
+                    break
+                self._convert(*noms)
+
+        def put(self,nom_AOT,nom_RH,nom_MR):
+            # blocks when taille_queue dates are waiting, to limit the space used by the netcdf files
+            if self.threads:
+                self.queue.put((nom_AOT,nom_RH,nom_MR))
+            else:
+                self._convert(nom_AOT,nom_RH,nom_MR)
+
+        def close(self):
+            """Waits for the end of the conversions, and returns the dates which could not be converted"""
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            return self.echecs
+
+
+def missing_files(a_telecharger,step,path_out,archive_dir,keep):
+        """Removes from the list of (date, time, file types) the dates already converted, and the files already
+        downloaded. The dates whose three files are already downloaded are converted"""
+        manquants = []
+        nb_archives = nb_converties = 0
+        for (dt, t, file_type) in a_telecharger:
+            noms, requests = cams_requests(dt,file_type,t,step,path_out)
+            if manifest.archive_ok(date_netcdf(noms[0])):
+                nb_archives += 1
+                continue
+            types_manquants = {}
+            for (type_fichier, nom) in zip(('surface', 'pressure', 'model'), (noms[0], noms[1], noms[2])):
+                types_manquants[type_fichier] = file_type[type_fichier] and not manifest.netcdf_ok(nom)
+            if True in types_manquants.values():
+                manquants.append((dt, t, types_manquants))
+            else:
+                conversions.put(noms[0],noms[1],noms[2])
+                nb_converties += 1
+        print '%d dates already converted, %d to convert from downloaded files, %d to download' % \
+            (nb_archives, nb_converties, len(manquants))
+        return manquants
+
+
+def download_all_files(a_telecharger,step,path_out,archive_dir,keep,max_requests,nb_transfers):
+        """Submits the requests of all the dates at the same time, and converts the files of a date
+        as soon as its three files are downloaded"""
+        requests = []
+        fichiers_restants = {}
+        for (dt, t, file_type) in a_telecharger:
+            noms, requests_date = cams_requests(dt,file_type,t,step,path_out)
+            requests.extend(requests_date)
+            for request in requests_date:
+                fichiers_restants[request['target']] = noms
+
+        echecs = []
+        for (request, error) in server.retrieve_many(requests, max_requests, nb_transfers):
+            nom = request['target']
+            if error is not None:
+                print 'Download of %s failed : %s' % (nom, error)
+                echecs.append(nom)
+                continue
+            print 'Downloaded :', nom
+            if manifest is not None:
+                manifest.record_netcdf(nom)
+            noms = fichiers_restants.pop(nom)
+            if not [n for n in noms if n in fichiers_restants] and not [n for n in noms if n in echecs]:
+                conversions.put(noms[0],noms[1],noms[2])
+        return echecs
+
+
+def retrieve_requests(requests,parallel,max_requests,nb_transfers):
+        """Yields (request, error) for each request, the requests being downloaded one after the other,
+        or all at the same time if parallel"""
+        if parallel:
+            for resultat in server.retrieve_many(requests, max_requests, nb_transfers):
+                yield resultat
+        else:
+            for request in requests:
+                print 'Nom fichier de sortie :',request['target']
+                try:
+                    server.retrieve(request)
+                except Exception as e:
+                    yield request, e
+                    continue
+                yield request, None
+
+
+def download_batch_files(a_telecharger,time,step,path_out,archive_dir,keep,batch_days,parallel,max_requests,nb_transfers):
+        """Downloads up to batch_days consecutive days in one request per file type, splits the files by date and time,
+        and converts a date as soon as its three files are there"""
+        dates = sorted(set([dt for (dt, t, file_type) in a_telecharger]))
+        file_type = {}
+        for type_fichier in PARAM_REQUESTS:
+            file_type[type_fichier] = True in [ft[type_fichier] for (dt, t, ft) in a_telecharger]
+        dates_voulues = set()
+        for (dt, t, ft) in a_telecharger:
+            dates_voulues.add(date_netcdf(cams_requests(dt,ft,t,step,path_out)[0][0]))
+
+        # series of consecutive days, of at most batch_days days
+        series = []
+        for dt in dates:
+            if series and (dt - series[-1][-1]).days == 1 and len(series[-1]) < batch_days:
+                series[-1].append(dt)
+            else:
+                series.append([dt])
+        requests = []
+        for serie in series:
+            requests.extend(batch_requests(serie[0],serie[-1],file_type,time,step,path_out))
+        nb_types = len([t for t in file_type if file_type[t]])
+
+        echecs = []
+        fichiers_par_date = {}
+        for (request, error) in retrieve_requests(requests,parallel,max_requests,nb_transfers):
+            nom_batch = request['target']
+            if error is not None:
+                print 'Download of %s failed : %s' % (nom_batch, error)
+                echecs.append(nom_batch)
+                continue
+            prefixe = os.path.basename(nom_batch).split('_')[1]
+            fichiers = split_cams_file(nom_batch, prefixe, path_out)
+            print 'Downloaded and split into %d dates :' % len(fichiers), nom_batch
+            os.remove(nom_batch)
+            for (date_nom, nom) in fichiers:
+                if manifest is not None:
+                    manifest.record_netcdf(nom)
+                if date_nom not in dates_voulues:
+                    # time of a date which was already converted
+                    if not(keep):
+                        os.remove(nom)
+                        if manifest is not None:
+                            manifest.remove_netcdf(nom)
+                    continue
+                fichiers_date = fichiers_par_date.setdefault(date_nom, {})
+                fichiers_date[prefixe] = nom
+                if len(fichiers_date) == nb_types:
+                    noms = [path_out + "/CAMS_" + p + "_" + date_nom + ".nc" for p in ('AOT', 'RH', 'MR')]
+                    if manifest is not None and [n for n in noms if not manifest.netcdf_ok(n)]:
+                        continue
+                    conversions.put(noms[0],noms[1],noms[2])
+                    del fichiers_par_date[date_nom]
+        for date_nom in sorted(fichiers_par_date):
+            print 'Incomplete files for %s : %s' % (date_nom, sorted(fichiers_par_date[date_nom].keys()))
+        return echecs
+
+
 #==============
 #     MAIN
 #==============
@@ -162,6 +352,30 @@ else :
         help="Path where the archive DBL files are stored")
     parser.add_option("-k","--keep", dest="keep", action="store_true",  \
                       help="keep netcdf files",default=False)
+    parser.add_option("-i","--incremental", dest="incremental", action="store_true",  \
+                      help="download only the files which are missing or corrupted in archive_dir and write_dir",default=False)
+    parser.add_option("--verify", dest="verify", action="store_true",  \
+                      help="check the md5 of the files (with -i), instead of their size only",default=False)
+    parser.add_option("-p","--parallel", dest="parallel", action="store_true",  \
+                      help="submit the requests of all the dates at once, and download them in parallel",default=False)
+    parser.add_option("--max_requests", dest="max_requests", action="store", type="int",  \
+                      help="maximum number of requests submitted at the same time (with -p)",default=20)
+    parser.add_option("--nb_transfers", dest="nb_transfers", action="store", type="int",  \
+                      help="number of results downloaded at the same time (with -p)",default=4)
+    parser.add_option("--nb_connections", dest="nb_connections", action="store", type="int",  \
+                      help="number of HTTP connections used to download each file (default 4)",default=4)
+    parser.add_option("--nb_conversions", dest="nb_conversions", action="store", type="int",  \
+                      help="number of dates converted to DBL/HDR at the same time, while the downloads go on (0 : conversion after each download)",default=2)
+    parser.add_option("--queue_size", dest="queue_size", action="store", type="int",  \
+                      help="maximum number of downloaded dates waiting for their conversion",default=8)
+    parser.add_option("-t","--tiles", dest="tiles", action="store", type="string",  \
+                      help="download only the area of these Sentinel-2 tiles, fmt('31TCJ,31TDJ')",default=None)
+    parser.add_option("-s","--sites", dest="sites", action="store", type="string",  \
+                      help="download only the area of these site files of prepare_mnt, fmt('32SNE.txt,france.txt')",default=None)
+    parser.add_option("--margin", dest="margin", action="store", type="float",  \
+                      help="margin around the tiles or sites, in degrees (default 2.5)",default=2.5)
+    parser.add_option("-b","--batch_days", dest="batch_days", action="store", type="int",  \
+                      help="number of days downloaded in a single request per file type, then split by date (default 0 : one request per date and time)",default=0)
     
     #parser.add_option("-t", "--time",dest="time", action="store", type="choice", \
     #    choices=['00','12'],help="Time of forecast (Currently '00'or'12)",default='00')
@@ -208,21 +422,54 @@ path_out = options.write_dir
 #Model    : MR  (mixing ratios)
 file_type={'surface':True,'pressure':True,'model':True}
 
+#Nombre de connexions paralleles par fichier
+server.nb_connections = options.nb_connections
+
+#Zone a telecharger
+bboxes = []
+if options.tiles is not None:
+    bboxes.extend([tile_latlon_bbox(tile.strip()) for tile in options.tiles.split(',')])
+if options.sites is not None:
+    bboxes.extend([site_latlon_bbox(fic_site.strip()) for fic_site in options.sites.split(',')])
+if bboxes:
+    area = cams_area(bboxes, options.margin)
+print 'Area =',area
+
+
+
+dates = [dt1 + datetime.timedelta(days=i) for i in range(nb_days)]
+a_telecharger = [(dt, t, file_type) for dt in dates for t in time]
 
+conversions = ConversionThreads(path_out,options.archive_dir,options.keep,options.nb_conversions,options.queue_size)
+try:
+    #Fichiers deja telecharges et convertis, le manifeste n'est tenu qu'en mode incremental
+    #les dates telechargees mais pas converties sont mises dans la file des conversions
+    if options.incremental:
+            manifest = CAMSManifest(options.archive_dir, options.verify)
+            a_telecharger = missing_files(a_telecharger,step,path_out,options.archive_dir,options.keep)
 
-#Boucle sur les jours a telecharger
-for i in range(nb_days):
-        dt = dt1 + datetime.timedelta(days=i)
-        print "=================================="
-        print "Downloading files for date %s"%dt
-        print "=================================="
-        for t in range(len(time)):
-            (nom_AOT,nom_RH,nom_MR)=download_files(dt,file_type,time[t],step,path_out)
-            #conversion to MAJA DBL/HDR format
-            process_one_file(nom_AOT, nom_MR, nom_RH, path_out, options.archive_dir)
-            if not(options.keep):
-                os.remove(nom_AOT)
-                os.remove(nom_MR)
-                os.remove(nom_RH)
-            
+    if options.batch_days > 0:
+            echecs = download_batch_files(a_telecharger,time,step,path_out,options.archive_dir,options.keep,
+                                          options.batch_days,options.parallel,options.max_requests,options.nb_transfers)
+    elif options.parallel:
+            echecs = download_all_files(a_telecharger,step,path_out,options.archive_dir,options.keep,
+                                        options.max_requests,options.nb_transfers)
+    else:
+        #Boucle sur les jours a telecharger
+        echecs = []
+        for (dt, t, file_type_date) in a_telecharger:
+                print "=================================="
+                print "Downloading files for date %s, time %s"%(dt,t)
+                print "=================================="
+                (nom_AOT,nom_RH,nom_MR)=download_files(dt,file_type_date,t,step,path_out)
+                conversions.put(nom_AOT,nom_RH,nom_MR)
+finally:
+    #les conversions en cours sont terminees, meme si un telechargement a echoue
+    echecs_conversion = conversions.close()
 
+if echecs:
+    print "%d files could not be downloaded" % len(echecs)
+if echecs_conversion:
+    print "%d dates could not be converted" % len(echecs_conversion)
+if echecs or echecs_conversion:
+    sys.exit(1)
@@ -11,10 +11,18 @@
 from __future__ import print_function
 
 import os
+import socket
 import sys
+import threading
 import time
 import traceback
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 
 # python 2 and 3 compatible urllib and httplib imports
 try:
@@ -22,13 +30,15 @@ try:
     from urllib.parse import urljoin
     from urllib.error import HTTPError, URLError
     from urllib.request import HTTPRedirectHandler, Request, build_opener, urlopen, addinfourl
-    from http.client import BadStatusLine
+    from urllib.request import getproxies, proxy_bypass
+    from http.client import BadStatusLine, HTTPConnection, HTTPSConnection, HTTPException
 except ImportError:
     from urlparse import urlparse
     from urlparse import urljoin
     from urllib2 import HTTPError, URLError
     from urllib2 import HTTPRedirectHandler, Request, build_opener, urlopen, addinfourl
-    from httplib import BadStatusLine
+    from urllib import getproxies, proxy_bypass
+    from httplib import BadStatusLine, HTTPConnection, HTTPSConnection, HTTPException
 
 try:
     import json
@@ -45,6 +55,14 @@ except ImportError:
 ###############################################################################
 VERSION = '1.5.0'
 
+# parallel transfer of the results
+CHUNK_SIZE = 8 * 1048576
+TRANSFER_TIMEOUT = 120
+MAX_CHUNK_TRIES = 10
+MAX_RETRY_DELAY = 60
+# polling of the queued requests
+MAX_POLL_INTERVAL = 120
+
 ###############################################################################
 
 
@@ -120,6 +138,10 @@ class RetryError(Exception):
         return "%d %s" % (self.code, self.text)
 
 
+class RangeNotSupported(Exception):
+    pass
+
+
 class APIException(Exception):
 
     def __init__(self, value):
@@ -152,6 +174,10 @@ def robust(func):
                 if self.verbose:
                     print("WARNING: URLError received %s %s" % (e.errno, e))
                 last_error = e
+            except (socket.error, HTTPException) as e:
+                if self.verbose:
+                    print("WARNING: connection error %s" % (e))
+                last_error = e
             except APIException:
                 raise
             except RetryError as e:
@@ -183,23 +209,25 @@ def get_api_url(url):
 SAY = True
 
 
+def say_moved(o, n):
+    global SAY
+    if SAY:
+        print()
+        print("*** ECMWF API has moved")
+        print("***   OLD: %s" % get_api_url(o))
+        print("***   NEW: %s" % get_api_url(n))
+        print("*** Please update your ~/.ecmwfapirc file")
+        print()
+        SAY = False
+
+
 class Ignore303(HTTPRedirectHandler):
 
     def redirect_request(self, req, fp, code, msg, headers, newurl):
         if code in [301, 302]:
             # We want the posts to work even if we are redirected
             if code == 301:
-                global SAY
-                if SAY:
-                    o = req.get_full_url()
-                    n = newurl
-                    print()
-                    print("*** ECMWF API has moved")
-                    print("***   OLD: %s" % get_api_url(o))
-                    print("***   NEW: %s" % get_api_url(n))
-                    print("*** Please update your ~/.ecmwfapirc file")
-                    print()
-                    SAY = False
+                say_moved(req.get_full_url(), newurl)
 
             try:
                 # Python < 3.4
@@ -229,6 +257,86 @@ class Ignore303(HTTPRedirectHandler):
         return infourl
 
 
+class HTTPConnectionPool(object):
+    """Keep-alive connections to the API servers, shared by all the requests and threads
+    a connection is taken from the pool for each call, and given back once the response is read"""
+
+    def __init__(self, max_idle=8, timeout=120):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _new(self, scheme, netloc):
+        # returns a new connection, and tells if the full url must be sent (plain http proxy)
+        host = urlparse("%s://%s" % (scheme, netloc))
+        proxy = getproxies().get(scheme)
+        if proxy and not proxy_bypass(host.hostname):
+            proxy = urlparse(proxy)
+            if scheme == "https":
+                conn = HTTPSConnection(proxy.hostname, proxy.port or 8080, timeout=self.timeout)
+                conn.set_tunnel(host.hostname, host.port or 443)
+                return conn, False
+            return HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=self.timeout), True
+        if scheme == "https":
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        return HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _get(self, key):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new(*key), False
+
+    def _put(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn[0].close()
+
+    def request(self, method, url, data=None, headers={}):
+        """Sends a request, following 301 and 302 redirections, and returns (code, headers, body)"""
+        for redirection in range(10):
+            parsed = urlparse(url)
+            key = (parsed.scheme, parsed.netloc)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+            while True:
+                ((conn, full_url), reused) = self._get(key)
+                try:
+                    conn.request(method, url if full_url else path, data, headers)
+                    res = conn.getresponse()
+                    body = res.read()
+                    break
+                except (socket.error, HTTPException):
+                    conn.close()
+                    # a kept-alive connection may have been closed by the server since its last use
+                    if not reused:
+                        raise
+            if res.will_close:
+                conn.close()
+            else:
+                self._put(key, (conn, full_url))
+
+            res_headers = dict([(name.lower(), value) for (name, value) in res.getheaders()])
+            if res.status in [301, 302] and "location" in res_headers:
+                # We want the posts to work even if we are redirected
+                newurl = urljoin(url, res_headers["location"])
+                if res.status == 301:
+                    say_moved(url, newurl)
+                url = newurl
+                continue
+            return res.status, res_headers, body
+        raise APIException("ecmwf.API error: too many redirections for %s" % (url, ))
+
+
+POOL = HTTPConnectionPool()
+
+
 class Connection(object):
 
     def __init__(self, url, email=None, key=None, verbose=False, quiet=False):
@@ -243,6 +351,7 @@ class Connection(object):
         self.verbose = verbose
         self.quiet = quiet
         self.status = None
+        self.pool = POOL
 
     @robust
     def call(self, url, payload=None, method="GET"):
@@ -255,52 +364,36 @@ class Connection(object):
 
         headers = {"Accept": "application/json", "From": self.email, "X-ECMWF-KEY": self.key}
 
-        opener = build_opener(Ignore303)
-
         data = None
         if payload is not None:
             data = json.dumps(payload).encode('utf-8')
             headers["Content-Type"] = "application/json"
 
         url = "%s?offset=%d&limit=500" % (url, self.offset)
-        req = Request(url=url, data=data, headers=headers)
-        if method:
-            req.get_method = lambda: method
 
         error = False
-        try:
-            try:
-                res = opener.open(req)
-            except HTTPError as e:
-                # It seems that some version of urllib2 are buggy
-                if e.code <= 299:
-                    res = e
-                else:
-                    raise
-        except HTTPError as e:
+        code, res_headers, body = self.pool.request(method, url, data, headers)
+        if code >= 400:
             if self.verbose:
-                print(e)
+                print("HTTP Error %s" % (code, ))
             error = True
-            res = e
             # 429: Too many requests
             # 502: Proxy Error
             # 503: Service Temporarily Unavailable
-            if e.code == 429 or e.code >= 500:
-                raise RetryError(e.code, e.read())
+            if code == 429 or code >= 500:
+                raise RetryError(code, body)
 
-        self.retry = int(res.headers.get("Retry-After", self.retry))
-        code = res.code
+        self.retry = int(res_headers.get("retry-after", self.retry))
         if code in [201, 202]:
-            self.location = urljoin(url, res.headers.get("Location", self.location))
+            self.location = urljoin(url, res_headers.get("location", self.location))
 
         if self.verbose:
             print("Code", code)
-            print("Content-Type", res.headers.get("Content-Type"))
-            print("Content-Length", res.headers.get("Content-Length"))
-            print("Location", res.headers.get("Location"))
+            print("Content-Type", res_headers.get("content-type"))
+            print("Content-Length", res_headers.get("content-length"))
+            print("Location", res_headers.get("location"))
 
-        body = res.read().decode("utf-8")
-        res.close()
+        body = body.decode("utf-8")
 
         if code in [204]:
             self.last = None
@@ -340,7 +433,7 @@ class Connection(object):
             raise APIException("ecmwf.API error 1: %s" % (self.last["error"],))
 
         if error:
-            raise APIException("ecmwf.API error 2: %s" % (res, ))
+            raise APIException("ecmwf.API error 2: HTTP %s %s" % (code, body))
 
         return self.last
 
@@ -379,17 +472,23 @@ def no_log(msg):
 
 class APIRequest(object):
 
-    def __init__(self, url, service, email=None, key=None, log=no_log, quiet=False, verbose=False, news=True):
+    def __init__(self, url, service, email=None, key=None, log=no_log, quiet=False, verbose=False, news=True,
+                 welcome=True, nb_connections=1, chunk_size=CHUNK_SIZE):
         self.url = url
         self.service = service
         self.connection = Connection(url, email, key, quiet=quiet, verbose=verbose)
         self.log = log
         self.quiet = quiet
         self.verbose = verbose
-        self.log("ECMWF API python library %s" % (VERSION,))
-        self.log("ECMWF API at %s" % (self.url,))
-        user = self.connection.call("%s/%s" % (self.url, "who-am-i"))
-        self.log("Welcome %s" % (user["full_name"] or "user '%s'" % user["uid"],))
+        self.status = None
+        # results larger than chunk_size are downloaded with nb_connections parallel Range requests
+        self.nb_connections = nb_connections
+        self.chunk_size = chunk_size
+        if welcome:
+            self.log("ECMWF API python library %s" % (VERSION,))
+            self.log("ECMWF API at %s" % (self.url,))
+            user = self.connection.call("%s/%s" % (self.url, "who-am-i"))
+            self.log("Welcome %s" % (user["full_name"] or "user '%s'" % user["uid"],))
         if news:
             try:
                 news = self.connection.call("%s/%s/%s" % (self.url, self.service, "news"))
@@ -445,45 +544,124 @@ class APIRequest(object):
 
         return existing_size + bytes_transferred
 
-    def execute(self, request, target=None):
-
-        status = None
+    def _log_status(self):
+        if self.connection.status != self.status:
+            self.status = self.connection.status
+            self.log("Request is %s" % (self.status, ))
 
+    def submit(self, request):
+        self.status = None
         self.connection.submit("%s/%s/requests" % (self.url, self.service), request)
         self.log('Request submitted')
         self.log('Request id: ' + self.connection.last.get('name'))
-        if self.connection.status != status:
-            status = self.connection.status
-            self.log("Request is %s" % (status, ))
+        self._log_status()
+
+    def poll(self):
+        """Checks the state of a submitted request once, without sleeping, and tells if the result is ready"""
+        if not self.connection.ready():
+            self.connection.call(self.connection.location, None, "GET")
+        self._log_status()
+        return self.connection.ready()
+
+    def _transfer_chunk(self, url, path, start, end):
+        """Writes bytes start to end (included) of url at the same position in path
+        an interrupted chunk is resumed where it stopped, after a delay which doubles at each try"""
+        transferred = 0
+        tries = 0
+        delay = 1
+        while True:
+            chunk_start = time.time()
+            try:
+                req = Request(url)
+                req.add_header("Range", "bytes=%d-%d" % (start + transferred, end))
+                with closing(urlopen(req, timeout=TRANSFER_TIMEOUT)) as http:
+                    if http.getcode() != 206:
+                        raise RangeNotSupported("HTTP %s received for a Range request" % http.getcode())
+                    with open(path, "r+b") as f:
+                        f.seek(start + transferred)
+                        while True:
+                            chunk = http.read(1048576)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            transferred += len(chunk)
+                if start + transferred != end + 1:
+                    raise IOError("incomplete chunk, %d bytes missing" % (end + 1 - start - transferred))
+                duration = time.time() - chunk_start
+                self.log("Chunk %d-%d transferred in %.1fs" % (start, end, duration))
+                return end + 1 - start
+            except HTTPError as e:
+                if e.code < 500:
+                    raise
+                error = e
+            except (IOError, OSError, BadStatusLine) as e:
+                error = e
+            tries += 1
+            if tries >= MAX_CHUNK_TRIES:
+                raise error
+            self.log("Chunk %d-%d interrupted (%s), resuming in %ds..." % (start, end, error, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
 
-        while not self.connection.ready():
-            if self.connection.status != status:
-                status = self.connection.status
-                self.log("Request is %s" % (status, ))
-            self.connection.wait()
+    def _transfer_chunks(self, url, path, size):
+        start = time.time()
+        # the file is preallocated, and each chunk is written at its own position
+        with open(path, "wb") as f:
+            f.truncate(size)
+        chunks = [(debut, min(debut + self.chunk_size, size) - 1) for debut in range(0, size, self.chunk_size)]
 
-        if self.connection.status != status:
-            status = self.connection.status
-            self.log("Request is %s" % (status, ))
+        self.log("Transfering %s into %s, in %d chunks on %d connections" %
+                 (self._bytename(size), path, len(chunks), min(self.nb_connections, len(chunks))))
+        self.log("From %s" % (url, ))
+
+        pool = ThreadPool(min(self.nb_connections, len(chunks)))
+        try:
+            transferred = sum(pool.map(lambda chunk: self._transfer_chunk(url, path, chunk[0], chunk[1]), chunks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
+        end = time.time()
+        if end > start:
+            self.log("Transfer rate %s/s" % self._bytename(transferred / (end - start)))
+        return transferred
+
+    def _transfer_stream(self, url, target, size):
+        # single transfer, resumed with a Range request if it is interrupted
+        if os.path.exists(target):
+            # Empty the target file, if it already exists, otherwise the
+            # transfer below might be fooled into thinking we're resuming
+            # an interrupted download.
+            open(target, "w").close()
+
+        transferred = -1
+        tries = 0
+        delay = 1
+        while transferred != size and tries < 10:
+            transferred = self._transfer(url, target, size)
+            if transferred != size and tries < 10:
+                tries += 1
+                self.log("Transfer interrupted, resuming in %ds..." % delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            else:
+                break
+        return transferred
+
+    def download(self, target=None):
+        """Transfers the result of a completed request into target, and deletes the request on the server"""
         result = self.connection.result()
         if target:
-            if os.path.exists(target):
-                # Empty the target file, if it already exists, otherwise the
-                # transfer below might be fooled into thinking we're resuming
-                # an interrupted download.
-                open(target, "w").close()
-
-            size = -1
-            tries = 0
-            while size != result["size"] and tries < 10:
-                size = self._transfer(urljoin(self.url, result["href"]), target, result["size"])
-                if size != result["size"] and tries < 10:
-                    tries += 1
-                    self.log("Transfer interrupted, resuming in 60s...")
-                    time.sleep(60)
-                else:
-                    break
+            url = urljoin(self.url, result["href"])
+            if self.nb_connections > 1 and result["size"] > self.chunk_size:
+                try:
+                    size = self._transfer_chunks(url, target, result["size"])
+                except RangeNotSupported as e:
+                    self.log("Parallel transfer not possible (%s), using a single connection" % (e, ))
+                    size = self._transfer_stream(url, target, result["size"])
+            else:
+                size = self._transfer_stream(url, target, result["size"])
 
             assert size == result["size"]
 
@@ -491,12 +669,124 @@ class APIRequest(object):
 
         return result
 
+    def execute(self, request, target=None):
+
+        self.submit(request)
+
+        while not self.connection.ready():
+            self._log_status()
+            self.connection.wait()
+
+        self._log_status()
+
+        return self.download(target)
+
+
+class APIRequestBatch(object):
+    """Runs many requests at the same time : they are all submitted, polled from a single loop,
+    and their results are transferred in parallel as soon as they are ready"""
+
+    def __init__(self, url, email=None, key=None, log=no_log, quiet=False, verbose=False,
+                 max_requests=20, nb_transfers=4, nb_connections=1):
+        self.url = url
+        self.nb_connections = nb_connections
+        self.email = email
+        self.key = key
+        self.log = log
+        self.quiet = quiet
+        self.verbose = verbose
+        # number of requests submitted to the server and not yet downloaded
+        self.max_requests = max_requests
+        self.nb_transfers = nb_transfers
+
+    def _download(self, api_request, request):
+        try:
+            api_request.download(request.get("target"))
+            return request, None
+        except Exception as e:
+            api_request.connection.cleanup()
+            return request, e
+
+    def retrieve(self, requests):
+        """Runs a list of (service, request), and yields (request, error) as soon as each request is
+        downloaded. error is None when the request succeeded, the exception raised otherwise"""
+        a_soumettre = list(requests)
+        a_soumettre.reverse()
+        actives = []  # [time of the next poll, polling interval, APIRequest, request]
+        termines = Queue.Queue()
+        nb_transferts = 0
+        pool = ThreadPool(self.nb_transfers)
+        try:
+            while a_soumettre or actives or nb_transferts:
+                while a_soumettre and len(actives) + nb_transferts < self.max_requests:
+                    (service, request) = a_soumettre.pop()
+                    api_request = APIRequest(self.url, service, self.email, self.key, self.log,
+                                             quiet=self.quiet, verbose=self.verbose, news=False, welcome=False,
+                                             nb_connections=self.nb_connections)
+                    try:
+                        api_request.submit(request)
+                    except Exception as e:
+                        yield request, e
+                        continue
+                    intervalle = api_request.connection.retry
+                    actives.append([time.time() + intervalle, intervalle, api_request, request])
+
+                maintenant = time.time()
+                for active in list(actives):
+                    (prochain, intervalle, api_request, request) = active
+                    if prochain > maintenant and not api_request.connection.ready():
+                        continue
+                    statut = api_request.status
+                    try:
+                        pret = api_request.poll()
+                    except Exception as e:
+                        actives.remove(active)
+                        api_request.connection.cleanup()
+                        yield request, e
+                        continue
+                    if pret:
+                        actives.remove(active)
+                        nb_transferts += 1
+                        pool.apply_async(self._download, (api_request, request), callback=termines.put)
+                    else:
+                        # the requests which do not progress are polled less and less often
+                        if api_request.status == statut:
+                            intervalle = min(intervalle * 1.5, MAX_POLL_INTERVAL)
+                        else:
+                            intervalle = api_request.connection.retry
+                        intervalle = max(intervalle, api_request.connection.retry)
+                        active[0:2] = [time.time() + intervalle, intervalle]
+
+                # wait for the end of a transfer, or for the next poll
+                if actives:
+                    delai = min([active[0] for active in actives]) - time.time()
+                else:
+                    delai = 1
+                try:
+                    resultat = termines.get(timeout=min(max(delai, 0.01), 60))
+                except Queue.Empty:
+                    continue
+                while True:
+                    nb_transferts -= 1
+                    yield resultat
+                    try:
+                        resultat = termines.get_nowait()
+                    except Queue.Empty:
+                        break
+            pool.close()
+        finally:
+            # the requests still running are deleted from the server if the batch is interrupted
+            for (prochain, intervalle, api_request, request) in actives:
+                api_request.connection.cleanup()
+            pool.terminate()
+            pool.join()
+
 
 ###############################################################################
 
 class ECMWFDataServer(object):
 
-    def __init__(self, url=None, key=None, email=None, verbose=False, log=None):
+    def __init__(self, url=None, key=None, email=None, verbose=False, log=None, nb_connections=1):
         if url is None or key is None or email is None:
             key, url, email = get_apikey_values()
 
@@ -505,6 +795,7 @@ class ECMWFDataServer(object):
         self.email = email
         self.verbose = verbose
         self.log = log
+        self.nb_connections = nb_connections
 
     def trace(self, m):
         if self.log:
@@ -516,9 +807,17 @@ class ECMWFDataServer(object):
     def retrieve(self, req):
         target = req.get("target")
         dataset = req.get("dataset")
-        c = APIRequest(self.url, "datasets/%s" % (dataset,), self.email, self.key, self.trace, verbose=self.verbose)
+        c = APIRequest(self.url, "datasets/%s" % (dataset,), self.email, self.key, self.trace, verbose=self.verbose,
+                       nb_connections=self.nb_connections)
         c.execute(req, target)
 
+    def retrieve_many(self, reqs, max_requests=20, nb_transfers=4):
+        """Retrieves a list of requests at the same time, and yields (request, error) as each one is downloaded"""
+        batch = APIRequestBatch(self.url, self.email, self.key, self.trace, verbose=self.verbose,
+                                max_requests=max_requests, nb_transfers=nb_transfers,
+                                nb_connections=self.nb_connections)
+        return batch.retrieve([("datasets/%s" % (req.get("dataset"),), req) for req in reqs])
+
 ###############################################################################
 
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Splits a CAMS netCDF file downloaded for several dates and times into one file per date and time,
+# named like the files downloaded date by date (CAMS_AOT_yyyymmddUTChh0000.nc)
+# Written for download_CAMS_daily.py, CESBIO
+#
+import datetime
+import os
+import os.path
+import re
+
+
+def dates_netcdf(variable_time):
+    """Returns the dates of the values of a netCDF time variable ("hours since 1900-01-01 00:00:00.0")"""
+    unites = variable_time.units
+    if isinstance(unites, bytes):
+        unites = unites.decode('ascii')
+    m = re.match(r"(\w+) since (\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2}))?", unites)
+    if m is None:
+        raise ValueError("Unexpected time units %s" % unites)
+    champs = [int(c) for c in m.groups()[1:] if c is not None]
+    origine = datetime.datetime(*champs)
+    facteur = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}[m.group(1)]
+    return [origine + datetime.timedelta(seconds=int(round(float(valeur) * facteur)))
+            for valeur in variable_time.data]
+
+
+def split_cams_file(nc_file, prefixe, path_out):
+    """Writes one file per date and time of nc_file in path_out
+    nc_file is memory mapped, so that only the values of one time are read at once
+    returns the list of (date as yyyymmddUTChhmmss, file name)"""
+    from scipy.io import netcdf
+
+    fichiers = []
+    src = netcdf.netcdf_file(nc_file, 'r', mmap=True, maskandscale=False)
+    try:
+        dates = dates_netcdf(src.variables['time'])
+        for (i, date) in enumerate(dates):
+            date_nom = date.strftime('%Y%m%dUTC%H%M%S')
+            nom = os.path.join(path_out, "CAMS_" + prefixe + "_" + date_nom + ".nc")
+            ecrit_date(src, i, nom + ".tmp")
+            os.rename(nom + ".tmp", nom)
+            fichiers.append((date_nom, nom))
+    finally:
+        src.close()
+    return fichiers
+
+
+def ecrit_date(src, i, nom):
+    # copy of the header and of the variables of src, restricted to the i-th time
+    # the values are copied out of the mapped file, so that src can be closed once all the times are written
+    import numpy as np
+    from scipy.io import netcdf
+
+    dst = netcdf.netcdf_file(nom, 'w', version=src.version_byte)
+    try:
+        for (attribut, valeur) in src._attributes.items():
+            setattr(dst, attribut, valeur)
+        for dimension in src._dims:
+            taille = src.dimensions[dimension]
+            if dimension == 'time' and taille is not None:
+                taille = 1
+            dst.createDimension(dimension, taille)
+        for (nom_var, var) in src.variables.items():
+            out = dst.createVariable(nom_var, var.typecode(), var.dimensions)
+            for (attribut, valeur) in var._attributes.items():
+                setattr(out, attribut, valeur)
+            if 'time' in var.dimensions:
+                tranche = [slice(None)] * len(var.dimensions)
+                tranche[var.dimensions.index('time')] = slice(i, i + 1)
+                out[:] = np.array(var.data[tuple(tranche)])
+            elif var.shape == ():
+                out.assignValue(var.getValue())
+            else:
+                out[:] = var.data
+    finally:
+        dst.close()
@@ -9,6 +9,9 @@ This tool, developped by O.Hagolle (CNES:CESBIO) is a very basic one to show how
 """
 
 import glob
+import json
+import multiprocessing
+import re
 import tempfile
 import optparse
 import os
@@ -27,6 +30,8 @@ if not logger.handlers:
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 START_MAJA_VERSION = 3.1
+CACHE_MANIFEST = "exo_cams_cache.json"  # signatures of the converted netcdf files
+CAMS_NETCDF_PATTERN = re.compile(r".*(AOT|MR|RH)_(\d{8}UTC\d{6})\.nc$")
 
 # #########################################################################
 class OptionParser(optparse.OptionParser):
@@ -46,9 +51,11 @@ def read_folders(fic_txt):
 
     with file(fic_txt, 'r') as f:
         for ligne in f.readlines():
-            if ligne.find('repCAMS') == 0:
+            # cle exacte, repCAMS ne doit pas lire la ligne repCAMS_raw
+            cle = ligne.split('=')[0].strip()
+            if cle == 'repCAMS':
                 repCAMS = (ligne.split('=')[1]).strip()
-            if ligne.find('repCAMS_raw') == 0:
+            if cle == 'repCAMS_raw':
                 repCAMS_raw = (ligne.split('=')[1]).strip()
 
     missing = False
@@ -66,7 +73,7 @@ def read_folders(fic_txt):
     if repCAMS is not None and not os.path.isdir(repCAMS):
         logger.error("repCAMS %s is missing", repCAMS)
     if repCAMS_raw is not None and not os.path.isdir(repCAMS_raw):
-        logger.error("repCAMS %s is missing", repCAMS_raw)
+        logger.error("repCAMS_raw %s is missing", repCAMS_raw)
 
     if directory_missing:
         raise Exception("One or more directories are missing. See log file for more information.")
@@ -74,30 +81,132 @@ def read_folders(fic_txt):
     return repCAMS, repCAMS_raw
 
 
-def manage_rep_cams(repCams, repCamsRaw, working_dir):
-    exocam_creation(repCamsRaw, out_dir=repCams, working_dir=repCams)
+def manage_rep_cams(repCams, repCamsRaw, working_dir, nb_procs=1):
+    exocam_creation(repCamsRaw, out_dir=repCams, working_dir=repCams, nb_procs=nb_procs)
     return repCams
 
-def exocam_creation(input_dir, out_dir=None, working_dir="/tmp"):
 
-    processed_dates = []
-
-    nb_files = len(myGlob(input_dir, "*.nc"))
-    compteur = 1
-
-    for file_cams in myGlob(input_dir, "*.nc"):
-        date_file = get_date(file_cams)
-        if date_file in processed_dates:
+def signature_cams(files):
+    # size and modification time of the netcdf files of a date
+    signature = {}
+    for fic in files:
+        stat = os.stat(fic)
+        signature[os.path.basename(fic)] = [stat.st_size, stat.st_mtime]
+    return signature
+
+
+def read_cache_manifest(out_dir):
+    manifest_file = os.path.join(out_dir, CACHE_MANIFEST)
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file) as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Manifest %s is corrupted, all CAMS files will be converted", manifest_file)
+    return {}
+
+
+def write_cache_manifest(out_dir, manifest):
+    manifest_file = os.path.join(out_dir, CACHE_MANIFEST)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifest_file + ".tmp", manifest_file)
+
+
+def group_cams_files(input_dir):
+    """Groups the netcdf files of input_dir by date, in one listing of the directory
+    returns a dictionary {date : {"AOT": file, "MR": file, "RH": file}}
+    """
+    triplets = {}
+    for base in os.listdir(input_dir):
+        m = CAMS_NETCDF_PATTERN.match(base)
+        if m is None:
+            continue
+        (type_cams, date_written_in_file) = m.groups()
+        triplet = triplets.setdefault(date_written_in_file, {})
+        if type_cams in triplet:
+            print("Warning, more than one {} file for date {} in {}".format(type_cams, date_written_in_file, input_dir))
+            continue
+        triplet[type_cams] = os.path.join(input_dir, base)
+    return triplets
+
+
+def convert_triplet(args):
+    # conversion of the netcdf files of one date, in a worker of the pool
+    from convert_to_exo import process_one_file
+    (date_written_in_file, aot_file, mr_file, rh_file, input_dir, out_dir, nb_threads) = args
+    dbl_file, hdr_file = process_one_file(aot_file, mr_file, rh_file, input_dir, out_dir, nb_threads)
+    return date_written_in_file, dbl_file, hdr_file
+
+
+def exocam_creation(input_dir, out_dir=None, working_dir="/tmp", nb_procs=1):
+    """Converts the CAMS netcdf files of input_dir into EXO_CAMS DBL/HDR files, in out_dir
+    a manifest stored in out_dir keeps the signature of the converted files, so that only new or
+    modified dates are converted. Dates are converted in parallel on nb_procs processes
+    """
+    if out_dir is None:
+        out_dir = working_dir
+    manifest = read_cache_manifest(out_dir)
+
+    a_convertir = []
+    nb_reused = 0
+    for (date_written_in_file, triplet) in sorted(group_cams_files(input_dir).items()):
+        if len(triplet) != 3:
+            logger.warning("Incomplete CAMS files for %s in %s : %s", date_written_in_file, input_dir,
+                           sorted(triplet.keys()))
             continue
-        #print("Processing {}/{} : {} ".format(compteur, nb_files/3,date_file), end='\r')
-        date_written_in_file = back_to_filename_date(date_file)
-        aot_file = searchOneFile(input_dir, "*AOT_{}*".format(date_written_in_file))
-        mr_file = searchOneFile(input_dir, "*MR_{}*".format(date_written_in_file))
-        rh_file = searchOneFile(input_dir, "*RH_{}*".format(date_written_in_file))
-        process_one_file(aot_file, mr_file, rh_file, out_dir, working_dir)
+        aot_file, mr_file, rh_file = triplet["AOT"], triplet["MR"], triplet["RH"]
+
+        signature = signature_cams([aot_file, mr_file, rh_file])
+        entry = manifest.get(date_written_in_file)
+        if entry is not None and entry["inputs"] == signature and \
+                os.path.exists(os.path.join(out_dir, entry["DBL"])) and \
+                os.path.exists(os.path.join(out_dir, entry["HDR"])):
+            nb_reused += 1
+            continue
+        if entry is not None:
+            # outdated conversion of the same date
+            for fic in (entry["DBL"], entry["HDR"]):
+                if os.path.exists(os.path.join(out_dir, fic)):
+                    os.remove(os.path.join(out_dir, fic))
+            del manifest[date_written_in_file]
+        a_convertir.append((date_written_in_file, signature, aot_file, mr_file, rh_file))
+
+    # processes of a pool cannot create their own pool, start_maja -j converts in the parent process
+    if multiprocessing.current_process().daemon and nb_procs > 1 and len(a_convertir) > 1:
+        logger.warning("Running in a daemon process, the %s CAMS dates are converted on 1 process instead of %s",
+                       len(a_convertir), nb_procs)
+        nb_procs = 1
+    nb_procs = max(1, min(nb_procs, len(a_convertir)))
+    # the remaining cores are used by the bzip2 compression of each date
+    nb_threads = max(1, multiprocessing.cpu_count() // nb_procs)
+
+    signatures = dict([(t[0], t[1]) for t in a_convertir])
+    taches = [(date_written_in_file, aot_file, mr_file, rh_file, input_dir, out_dir, nb_threads)
+              for (date_written_in_file, signature, aot_file, mr_file, rh_file) in a_convertir]
+    if nb_procs > 1:
+        pool = multiprocessing.Pool(nb_procs)
+        resultats = pool.imap_unordered(convert_triplet, taches)
+    else:
+        pool = None
+        resultats = (convert_triplet(tache) for tache in taches)
+
+    try:
+        for (compteur, (date_written_in_file, dbl_file, hdr_file)) in enumerate(resultats):
+            print("Processing {}/{} : {} ".format(compteur + 1, len(taches), date_written_in_file))
+            manifest[date_written_in_file] = {"inputs": signatures[date_written_in_file],
+                                              "DBL": os.path.basename(dbl_file),
+                                              "HDR": os.path.basename(hdr_file)}
+            write_cache_manifest(out_dir, manifest)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    logger.info("%s CAMS dates converted, %s reused from %s", len(taches), nb_reused, out_dir)
 
-        processed_dates.append(date_file)
-        compteur += 1
 
 if __name__ == '__main__':
     # ========== command line
@@ -119,6 +228,9 @@ if __name__ == '__main__':
         parser.add_option("-f", "--folder", dest="folder_file", action="store", type="string",
                           help="folder definition file", default=None)
 
+        parser.add_option("-n", "--nb_procs", dest="nb_procs", action="store", type="int",
+                          help="number of dates converted in parallel", default=multiprocessing.cpu_count())
+
         (options, args) = parser.parse_args()
 
 
@@ -126,4 +238,4 @@ if __name__ == '__main__':
     # =================directories
     folder_file = options.folder_file
     (repCams, repCamsRaw) = read_folders(folder_file)
-    repCams = manage_rep_cams(repCams, repCamsRaw, repCams)
+    repCams = manage_rep_cams(repCams, repCamsRaw, repCams, options.nb_procs)
@@ -35,9 +35,12 @@ import datetime
 import glob
 import os
 import re
-import shutil
+import subprocess
 import sys
+import tarfile
 import tempfile
+import time
+from distutils.spawn import find_executable
 
 import lxml.etree as ET
 
@@ -172,11 +175,45 @@ def nodes(root, mission, basename_out, dbl_file, date_now, acquisition_date, cam
     b4.text = "0.2 0.3843 0.6365 0.9564 1.3448 1.8058 2.3478 2.985 3.7397 4.6462 5.7565 7.1322 8.8366 10.9483 13.5647 16.8064 20.8227 25.7989 31.9642 39.6029 49.0671 60.1802 73.0663 87.7274 104.229 122.614 142.902 165.089 189.147 215.025 242.652 272.059 303.217 336.044 370.407 406.133 443.009 480.791 519.209 557.973 596.777 635.306 673.24 710.263 746.063 780.346 812.83 843.263 871.42 897.112 920.189 940.551 958.148 972.987 985.14 994.747 1002.02 1007.26 1010.85 1013.25"
 
 
-def compress_directory_bzip2(destination_filename, source_directory):
-    basePath = os.path.dirname(source_directory)
-    baseModule = os.path.basename(source_directory)
-    command = "tar -cjf {} -C{} {} --exclude '.svn'".format(destination_filename, basePath, baseModule)
-    os.system(command)
+def parallel_bzip2(nb_threads):
+    """Returns the command of a multi-threaded bzip2 compressor, or None if none is installed"""
+    if nb_threads > 1:
+        if find_executable("lbzip2"):
+            return "lbzip2 -n {}".format(nb_threads)
+        if find_executable("pbzip2"):
+            return "pbzip2 -p{}".format(nb_threads)
+    return None
+
+
+def compress_files_bzip2(destination_filename, member_dir, files, nb_threads=1):
+    """Writes the files into a bzip2 tar archive, as members member_dir/<file name>
+    the files are streamed into the archive, without any intermediate copy
+    symbolic links are followed, so that the archive contains the data of staged or cached inputs
+    """
+    temp_filename = destination_filename + ".tmp"
+    compressor = parallel_bzip2(nb_threads)
+    with open(temp_filename, "wb") as f:
+        if compressor is not None:
+            process = subprocess.Popen(compressor.split(), stdin=subprocess.PIPE, stdout=f)
+            tar = tarfile.open(fileobj=process.stdin, mode="w|", dereference=True)
+        else:
+            process = None
+            tar = tarfile.open(fileobj=f, mode="w|bz2", dereference=True)
+        try:
+            directory = tarfile.TarInfo(member_dir)
+            directory.type = tarfile.DIRTYPE
+            directory.mode = 0o755
+            directory.mtime = time.time()
+            tar.addfile(directory)
+            for fic in files:
+                tar.add(fic, arcname=os.path.join(member_dir, os.path.basename(fic)))
+        finally:
+            tar.close()
+            if process is not None:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise Exception("Compression of {} failed".format(destination_filename))
+    os.rename(temp_filename, destination_filename)
 
 
 def date_time_for_naming(datetime_object):
@@ -192,17 +229,12 @@ def date_time_for_naming(datetime_object):
                                                           datetime_object.second)
 
 
-def create_archive(aot_file, mr_file, rh_file, output_file_basename, ncdf_dir, archive_dir):
+def create_archive(aot_file, mr_file, rh_file, output_file_basename, ncdf_dir, archive_dir, nb_threads=1):
     destination_filename = "{}.DBL".format(output_file_basename)
     destination_filepath = os.path.join(archive_dir, destination_filename)
 
-    temp_dir = os.path.join(archive_dir, output_file_basename + ".DBL.DIR")
-    os.makedirs(temp_dir)
-    shutil.copy(aot_file, os.path.join(temp_dir, os.path.basename(aot_file)))
-    shutil.copy(mr_file, os.path.join(temp_dir, os.path.basename(mr_file)))
-    shutil.copy(rh_file, os.path.join(temp_dir, os.path.basename(rh_file)))
-
-    compress_directory_bzip2(destination_filepath, archive_dir)
+    compress_files_bzip2(destination_filepath, destination_filename + ".DIR", [aot_file, mr_file, rh_file],
+                         nb_threads)
     cams_file_to_return = [os.path.join(destination_filename + ".DIR", os.path.basename(aot_file)),
                            os.path.join(destination_filename + ".DIR", os.path.basename(mr_file)),
                            os.path.join(destination_filename + ".DIR", os.path.basename(rh_file))]
@@ -238,7 +270,7 @@ def back_to_filename_date(datetime_file):
     return datetime_file.strftime("%Y%m%dUTC%H%M%S")
 
 
-def process_one_file(aot_file, mr_file, rh_file, ncdf_dir, archive_dir):
+def process_one_file(aot_file, mr_file, rh_file, ncdf_dir, archive_dir, nb_threads=1):
 
     #working_dir = tempfile.mkdtemp(dir=working_dir)
 
@@ -250,7 +282,8 @@ def process_one_file(aot_file, mr_file, rh_file, ncdf_dir, archive_dir):
                                                             date_time_for_naming(date_now))
 
     #create archive
-    dbl_filename, cams = create_archive(aot_file, mr_file, rh_file, output_file_basename, ncdf_dir, archive_dir)
+    dbl_filename, cams = create_archive(aot_file, mr_file, rh_file, output_file_basename, ncdf_dir, archive_dir,
+                                        nb_threads)
 
     print("Step 1/2", end='\r')
 
@@ -271,4 +304,6 @@ def process_one_file(aot_file, mr_file, rh_file, ncdf_dir, archive_dir):
                         encoding="UTF-8"))
     f.close()
 
+    return dbl_filename, output_filename
+
 
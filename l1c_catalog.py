@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent catalog of the Sentinel-2 L1C products stored in a site directory, used by start_maja.py
+
+The catalog is a SQLite file, indexed by tile and acquisition date. It is updated incrementally : the
+site directory is only listed when its modification time changed, and only new or modified products are parsed.
+
+==================== Copyright
+Software (l1c_catalog.py)
+
+Copyright© 2018 Centre National d’Etudes Spatiales
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3
+as published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this program.  If not, see
+https://www.gnu.org/licenses/gpl-3.0.fr.html
+"""
+
+import os
+import os.path
+import re
+import sqlite3
+
+import logging
+logger = logging.getLogger('Start-Maja')
+
+TILE_PATTERN = re.compile(r"_T(\d{2}[A-Z]{3})(_|$)")
+
+
+def parse_L1C_name(rac):
+    """Returns (acquisition date, production date, orbit) from a L1C product name
+    both the old (S2A_OPER_PRD_MSIL1C...) and the new (S2A_MSIL1C...) naming conventions are accepted
+    """
+    champs = rac.split('_')
+    if rac[4:].startswith("OPER_PRD_MSIL1C"):
+        return champs[7][1:9], champs[5], champs[6]
+    else:
+        return champs[2][0:8], champs[6], champs[4]
+
+
+class L1CCatalog(object):
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # several tiles of a site may be processed at the same time (start_maja -j)
+        self.connection = sqlite3.connect(db_file, timeout=120)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS products (path TEXT, tile TEXT, orbit TEXT, "
+                                    "date_img TEXT, date_prod TEXT, zipped INTEGER, PRIMARY KEY (path, tile))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS products_tile_date "
+                                    "ON products (tile, zipped, date_img)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime REAL)")
+
+    def close(self):
+        self.connection.close()
+
+    def _tiles(self, path, rac, zipped):
+        # the tile is in the name of recent products, old products can contain several granules
+        if zipped or not rac[4:].startswith("OPER_PRD_MSIL1C"):
+            tiles = [m.group(1) for m in [TILE_PATTERN.search(os.path.splitext(rac)[0])] if m is not None]
+        else:
+            tiles = []
+            try:
+                granules = os.listdir(os.path.join(path, "GRANULE"))
+            except OSError:
+                granules = []
+            for granule in granules:
+                m = TILE_PATTERN.search(granule)
+                if m is not None:
+                    tiles.append(m.group(1))
+        return tiles
+
+    def update(self, repL1, force=False):
+        """Adds the new products of repL1 to the catalog, and removes the products which disappeared
+        repL1 is only listed if its modification time changed since the last update, or if force is True
+        """
+        repL1 = os.path.abspath(repL1)
+        mtime = os.stat(repL1).st_mtime
+        cursor = self.connection.cursor()
+        row = cursor.execute("SELECT mtime FROM directories WHERE path=?", (repL1,)).fetchone()
+        if row is not None and row[0] == mtime and not force:
+            logger.debug("L1C catalog of %s is up to date", repL1)
+            return
+
+        known = dict(cursor.execute("SELECT path, mtime FROM entries WHERE path LIKE ?",
+                                    (os.path.join(repL1, "%"),)).fetchall())
+        present = set()
+        nb_new = 0
+        with self.connection:
+            for rac in os.listdir(repL1):
+                if not (rac.startswith("S2") and "MSIL1C" in rac):
+                    continue
+                if rac.endswith(".zip"):
+                    zipped = 1
+                elif rac.endswith(".SAFE"):
+                    zipped = 0
+                else:
+                    continue
+                path = os.path.join(repL1, rac)
+                present.add(path)
+                entry_mtime = os.stat(path).st_mtime
+                if known.get(path) == entry_mtime:
+                    continue
+                try:
+                    (date_img, date_prod, orbit) = parse_L1C_name(rac)
+                except IndexError:
+                    logger.warning("Unexpected L1C product name %s", rac)
+                    continue
+                cursor.execute("DELETE FROM products WHERE path=?", (path,))
+                for tile in self._tiles(path, rac, zipped):
+                    cursor.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)",
+                                   (path, tile, orbit, date_img, date_prod, zipped))
+                cursor.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (path, entry_mtime))
+                nb_new += 1
+
+            removed = [path for path in known if path not in present]
+            for path in removed:
+                cursor.execute("DELETE FROM products WHERE path=?", (path,))
+                cursor.execute("DELETE FROM entries WHERE path=?", (path,))
+            cursor.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (repL1, mtime))
+        logger.info("L1C catalog of %s updated : %s new, %s removed", repL1, nb_new, len(removed))
+
+    def select(self, tile, orbit, zipped, start_date, end_date):
+        """Returns a dictionary {acquisition date : product path} for a tile
+        when several products exist for the same date, the one with the most recent production date is kept
+        """
+        requete = "SELECT date_img, path, MAX(date_prod) FROM products " \
+                  "WHERE tile=? AND zipped=? AND date_img>=? AND date_img<=?"
+        parametres = [tile, int(bool(zipped)), start_date, end_date]
+        if orbit is not None:
+            requete += " AND orbit LIKE ?"
+            parametres.append("%" + orbit)
+        requete += " GROUP BY date_img"
+        prod_par_dateImg = {}
+        for (date_img, path, date_prod) in self.connection.execute(requete, parametres):
+            prod_par_dateImg[str(date_img)] = str(path)
+        return prod_par_dateImg
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Index of the L2A products of a tile, used by start_maja.py to find the last processed date and the
+previous L2A product without scanning the L2A directory for every date.
+
+The index is a JSON file stored in the L2A directory of the tile. It is built from a single listing of the
+directory when it does not exist, and updated after each MAJA execution.
+
+==================== Copyright
+Software (l2_index.py)
+
+Copyright© 2018 Centre National d’Etudes Spatiales
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3
+as published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this program.  If not, see
+https://www.gnu.org/licenses/gpl-3.0.fr.html
+"""
+
+import bisect
+import json
+import os
+import os.path
+import re
+
+import logging
+logger = logging.getLogger('Start-Maja')
+
+L2_INDEX_FILE = "L2_index.json"
+
+
+class L2Index(object):
+
+    def __init__(self, repL2, tile):
+        self.repL2 = repL2
+        self.tile = tile
+        self.fichier = os.path.join(repL2, L2_INDEX_FILE)
+        self.pattern_Natif = re.compile(r"^S2._OPER_SSC_L2(VALD|NOTV)_%s____(\d{8})\.DBL\.DIR$" % tile)
+        self.pattern_MUSCATE = re.compile(r"^(L2NOTV_)?SENTINEL2._(\d{8})-.*_T%s_C_V" % tile)
+        self.produits = {}
+        self.dates_valides = {"Natif": [], "MUSCATE": []}
+        if os.path.exists(self.fichier):
+            try:
+                with open(self.fichier) as f:
+                    self.produits = json.load(f)
+            except ValueError:
+                logger.warning("L2 index %s is corrupted, it will be rebuilt", self.fichier)
+                self.rebuild()
+        else:
+            self.rebuild()
+        self._trie_dates()
+
+    def _trie_dates(self):
+        self.dates_valides = {"Natif": [], "MUSCATE": []}
+        for (d, produit) in self.produits.items():
+            if produit["valid"]:
+                self.dates_valides[produit["type"]].append(d)
+        for L2type in self.dates_valides:
+            self.dates_valides[L2type].sort()
+
+    def save(self):
+        fichier_tmp = self.fichier + ".tmp"
+        with open(fichier_tmp, "w") as f:
+            json.dump(self.produits, f, indent=1, sort_keys=True)
+        os.rename(fichier_tmp, self.fichier)
+
+    def rebuild(self):
+        """Builds the index from one listing of the L2A directory"""
+        self.produits = {}
+        for nom in sorted(os.listdir(self.repL2)):
+            m = self.pattern_Natif.match(nom)
+            if m is not None:
+                self._ajoute(m.group(2), "Natif", os.path.join(self.repL2, nom), m.group(1) == "VALD")
+                continue
+            m = self.pattern_MUSCATE.match(nom)
+            if m is not None:
+                self._ajoute(m.group(2), "MUSCATE", os.path.join(self.repL2, nom), m.group(1) is None)
+        logger.info("L2 index of %s rebuilt : %s products", self.repL2, len(self.produits))
+        self.save()
+        self._trie_dates()
+
+    def _ajoute(self, d, L2type, path, valid):
+        # a valid product is never replaced by a non valid one for the same date
+        if d in self.produits and self.produits[d]["valid"] and not valid:
+            return
+        self.produits[d] = {"type": L2type, "path": path, "valid": valid}
+
+    def record(self, d, L2type, path, valid):
+        """Records the L2A product issued by MAJA for date d"""
+        self._ajoute(d, L2type, path, valid)
+        self.save()
+        self._trie_dates()
+
+    def remove(self, d):
+        """Removes date d from the index, for instance after an interrupted MAJA execution"""
+        if self.produits.pop(d, None) is not None:
+            self.save()
+            self._trie_dates()
+
+    def get(self, d):
+        """Returns the valid L2A product of date d, or None if there is none or if it was removed from the disk"""
+        produit = self.produits.get(d)
+        if produit is None or not produit["valid"]:
+            return None
+        if not os.path.exists(produit["path"]):
+            # the L2A directory was modified outside of start_maja
+            logger.warning("L2 product %s disappeared, rebuilding L2 index", produit["path"])
+            self.rebuild()
+            return self.get(d)
+        return produit
+
+    def last_date(self, dates):
+        """Returns the most recent date of the list with a valid L2A product, or an empty string"""
+        derniereDate = ""
+        for d in dates:
+            if d > derniereDate and self.get(d) is not None:
+                derniereDate = d
+        return derniereDate
+
+    def previous(self, d, L2type, date_min=""):
+        """Returns the path of the most recent valid L2A product of type L2type acquired before date d"""
+        dates = self.dates_valides[L2type]
+        i = bisect.bisect_left(dates, d)
+        if i == 0 or dates[i - 1] < date_min:
+            return ""
+        path = self.produits[dates[i - 1]]["path"]
+        if not os.path.exists(path):
+            # the L2A directory was modified outside of start_maja
+            logger.warning("L2 product %s disappeared, rebuilding L2 index", path)
+            self.rebuild()
+            return self.previous(d, L2type, date_min)
+        return path
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare le noyau de calcul de la pente et de l'orientation (classe_noyau_pente_aspect) aux calculs
+d'origine de calcul_pente_aspect_fic et calcul_pente_aspect_mem : temps de calcul et écarts sur les int16 produits
+Le noyau float32, utilisé par défaut, doit rester dans la tolérance (-t, en centièmes de radian), sinon le code
+de retour est 1
+
+exemple : python bench_pente_aspect.py -n 4096 -r 3
+"""
+
+import optparse
+import sys
+import time
+
+import numpy as np
+
+from lib_mnt import classe_noyau_pente_aspect, LIGNES_BLOC
+
+
+def pente_aspect_fic(dz_dl, dz_dc):
+    # calcul d'origine de classe_mnt.calcul_pente_aspect_fic
+    norme = np.sqrt((dz_dc) * (dz_dc) + (dz_dl) * (dz_dl))
+    slope = np.arctan(norme)
+    aspect = np.where(dz_dc > 0, np.arccos(dz_dl / norme), 2 * np.pi - np.arccos(dz_dl / norme))
+    aspect = np.where(slope == 0, 0, aspect)
+    return (slope * 100.).astype('int16'), (aspect * 100.).astype('int16')
+
+
+def pente_aspect_mem(dz_dl, dz_dc):
+    # calcul d'origine de calcul_pente_aspect_mem
+    norme = np.sqrt((dz_dc) * (dz_dc) + (dz_dl) * (dz_dl))
+    slope = np.arctan(norme)
+    aspect = np.where(dz_dc > 0, np.arccos(dz_dl / norme), 2 * np.pi - np.arccos(dz_dl / norme))
+    aspect = np.where(slope == 0, 0, aspect)
+    slope = np.where(np.isfinite(slope), slope, 0)
+    aspect = np.where(np.isfinite(aspect), aspect, 0)
+    return (slope * 100.).astype('int16'), (aspect * 100.).astype('int16')
+
+
+def noyau_blocs(type_calcul):
+    def calcul(dz_dl, dz_dc):
+        noyau = classe_noyau_pente_aspect(min(LIGNES_BLOC, dz_dl.shape[0]), dz_dl.shape[1], type_calcul)
+        slope = np.empty(dz_dl.shape, 'int16')
+        aspect = np.empty(dz_dl.shape, 'int16')
+        for l0 in range(0, dz_dl.shape[0], LIGNES_BLOC):
+            l1 = min(dz_dl.shape[0], l0 + LIGNES_BLOC)
+            (slope[l0:l1], aspect[l0:l1]) = noyau.calcule(dz_dl[l0:l1], dz_dc[l0:l1])
+        return slope, aspect
+    return calcul
+
+
+def gradients_test(n):
+    # gradients d'un relief aléatoire lissé, avec des zones plates et quelques pixels non finis
+    rng = np.random.RandomState(0)
+    dz_dl = rng.normal(0, 0.3, (n, n)).astype('float32')
+    dz_dc = rng.normal(0, 0.3, (n, n)).astype('float32')
+    dz_dl[:, :n // 10] = 0
+    dz_dc[:, :n // 10] = 0
+    dz_dl[n // 2, n // 2] = np.nan
+    dz_dc[n // 3, n // 3] = np.inf
+    return dz_dl, dz_dc
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", dest="taille", action="store", type="int", help="taille de l'image (n x n)",
+                      default=4096)
+    parser.add_option("-r", dest="repetitions", action="store", type="int", help="nombre de répétitions",
+                      default=3)
+    parser.add_option("-t", dest="tolerance", action="store", type="int",
+                      help="écart maximal admis pour le noyau float32, en centièmes de radian", default=0)
+    (options, args) = parser.parse_args()
+
+    # les calculs d'origine divisent par les normes nulles
+    np.seterr(divide='ignore', invalid='ignore')
+    (dz_dl, dz_dc) = gradients_test(options.taille)
+    finis = np.isfinite(dz_dl) & np.isfinite(dz_dc)
+    (ref_slope, ref_aspect) = pente_aspect_mem(dz_dl, dz_dc)
+
+    print "image %d x %d, %d répétitions" % (options.taille, options.taille, options.repetitions)
+    ecarts = {}
+    for (nom, fonction) in (("calcul_pente_aspect_fic", pente_aspect_fic),
+                            ("calcul_pente_aspect_mem", pente_aspect_mem),
+                            ("noyau float32", noyau_blocs(np.float32)),
+                            ("noyau float64", noyau_blocs(np.float64))):
+        temps = []
+        for i in range(options.repetitions):
+            debut = time.time()
+            (slope, aspect) = fonction(dz_dl, dz_dc)
+            temps.append(time.time() - debut)
+        ecart_slope = np.abs(slope[finis].astype(int) - ref_slope[finis])
+        ecart_aspect = np.abs(aspect[finis].astype(int) - ref_aspect[finis])
+        print "%-25s %8.3f s   écart max slope %d (%d pixels)  aspect %d (%d pixels)" % (
+            nom, min(temps), ecart_slope.max(), (ecart_slope > 0).sum(), ecart_aspect.max(),
+            (ecart_aspect > 0).sum())
+        ecarts[nom] = max(ecart_slope.max(), ecart_aspect.max())
+
+    if ecarts["noyau float32"] > options.tolerance:
+        print "ERREUR : écart du noyau float32 %d > tolérance %d" % (ecarts["noyau float32"], options.tolerance)
+        sys.exit(1)
+    print "noyau float32 dans la tolérance de %d centième(s) de radian" % options.tolerance
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Emprise des tuiles d'un site en lat/lon, et liste des fichiers SRTM, Planet Observer et SWBD qui la recouvrent
+
+Les bords des tuiles sont densifiés avant d'être projetés en lat/lon, en un seul appel, pour suivre la courbure
+des bords des tuiles UTM. Les fichiers MNT et eau étant sur des grilles régulières en lat/lon, l'index spatial
+des fichiers disponibles est un dictionnaire indexé par cellule de la grille.
+"""
+
+import glob
+import os
+import os.path
+import re
+
+import numpy as np
+from osgeo import ogr, osr
+
+# pas des grilles des fichiers, en degrés
+PAS_GRILLE = {"SRTM": 5, "PO": 1, "SWBD": 1}
+# nombre de points par bord de tuile
+NB_POINTS_BORD = 100
+
+
+############################ Noms des fichiers d'une cellule (lon_min, lat_min)
+def nom_srtm(cellule):
+    (lon_min, lat_min) = cellule
+    return "srtm_%02d_%02d.tif" % ((lon_min + 180) / 5 + 1, (55 - lat_min) / 5 + 1)
+
+
+def _nom_lonlat(cellule):
+    (x, y) = cellule
+    if x >= 0:
+        ew = "e"
+        num_x = x
+    else:
+        ew = "w"
+        num_x = -x
+    if y >= 0:
+        ns = "n"
+        num_y = y
+    else:
+        ns = "s"
+        num_y = -y
+    return ew, num_x, ns, num_y
+
+
+def nom_po(cellule):
+    return "%s%03d/%s%02d.dt1" % _nom_lonlat(cellule)
+
+
+def nom_swbd(cellule):
+    return "%s%03d%s%02d" % _nom_lonlat(cellule)
+
+
+NOMS = {"SRTM": nom_srtm, "PO": nom_po, "SWBD": nom_swbd}
+
+
+############################ Emprise des tuiles
+def tuiles_site(site):
+    """Liste des tuiles (tx, ty, ulx, uly, lrx, lry) d'un site, dans sa projection"""
+    tuiles = []
+    for tx in range(site.tx_min, site.tx_max + 1):
+        for ty in range(site.ty_min, site.ty_max + 1):
+            ulx = site.orig_x + tx * site.pas_x  # upper left
+            uly = site.orig_y + ty * site.pas_y
+            lrx = site.orig_x + (tx + 1) * site.pas_x + site.marge  # lower left
+            lry = site.orig_y + (ty - 1) * site.pas_y - site.marge
+            tuiles.append((tx, ty, ulx, uly, lrx, lry))
+    return tuiles
+
+
+def transformation_latlon(EPSG):
+    latlon = osr.SpatialReference()
+    latlon.SetWellKnownGeogCS("WGS84")
+    proj = osr.SpatialReference()
+    proj.ImportFromEPSG(EPSG)
+    # ordre lon, lat avec gdal >= 3
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        latlon.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(proj, latlon)
+
+
+def contour_densifie(ulx, uly, lrx, lry, nb_points=NB_POINTS_BORD):
+    """Points du contour d'un rectangle, nb_points par bord, dans le sens des aiguilles d'une montre"""
+    t = np.linspace(0., 1., nb_points, endpoint=False)
+    xs = np.concatenate([ulx + t * (lrx - ulx), np.repeat(lrx, nb_points), lrx - t * (lrx - ulx),
+                         np.repeat(ulx, nb_points)])
+    ys = np.concatenate([np.repeat(uly, nb_points), uly - t * (uly - lry), np.repeat(lry, nb_points),
+                         lry + t * (uly - lry)])
+    return xs, ys
+
+
+def emprises_latlon(tuiles, EPSG, nb_points=NB_POINTS_BORD):
+    """Polygones ogr en lat/lon des tuiles (tx, ty, ulx, uly, lrx, lry), projetés en un seul appel"""
+    contours = [contour_densifie(ulx, uly, lrx, lry, nb_points) for (tx, ty, ulx, uly, lrx, lry) in tuiles]
+    points = np.column_stack([np.concatenate([xs for (xs, ys) in contours]),
+                              np.concatenate([ys for (xs, ys) in contours])])
+    lonlat = np.array(transformation_latlon(EPSG).TransformPoints(points.tolist()))[:, 0:2]
+
+    emprises = []
+    nb = 4 * nb_points
+    for i in range(len(tuiles)):
+        anneau = lonlat[i * nb:(i + 1) * nb]
+        anneau = np.vstack([anneau, anneau[0:1]])
+        wkt = "POLYGON ((%s))" % ",".join(["%.9f %.9f" % (lon, lat) for (lon, lat) in anneau])
+        emprises.append(ogr.CreateGeometryFromWkt(wkt))
+    return emprises
+
+
+def cellules(emprise, pas):
+    """Cellules (lon_min, lat_min) de la grille de pas degrés dont l'intersection avec l'emprise n'est pas vide"""
+    (lon_min, lon_max, lat_min, lat_max) = emprise.GetEnvelope()
+    liste = []
+    for x in range(int(np.floor(lon_min / pas)) * pas, int(np.ceil(lon_max / pas)) * pas, pas):
+        for y in range(int(np.floor(lat_min / pas)) * pas, int(np.ceil(lat_max / pas)) * pas, pas):
+            cellule = ogr.CreateGeometryFromWkt("POLYGON ((%d %d,%d %d,%d %d,%d %d,%d %d))" %
+                                                (x, y, x + pas, y, x + pas, y + pas, x, y + pas, x, y))
+            # les cellules qui touchent seulement le bord de l'emprise sont exclues
+            if emprise.Intersects(cellule) and emprise.Intersection(cellule).GetArea() > 0:
+                liste.append((x, y))
+    return liste
+
+
+############################ Index des fichiers disponibles
+class classe_index_fichiers:
+    """Index des fichiers MNT (SRTM ou PO) ou eau (SWBD) d'un répertoire, par cellule de leur grille"""
+
+    def __init__(self, rep, type_fichier):
+        self.rep = rep
+        self.type_fichier = type_fichier
+        self.pas = PAS_GRILLE[type_fichier]
+        self.fichiers = {}
+        if type_fichier == "SRTM":
+            for fic in os.listdir(rep):
+                m = re.match(r"^srtm_(\d{2})_(\d{2})\.(tif|zip)$", fic)
+                if m is not None:
+                    cellule = ((int(m.group(1)) - 1) * 5 - 180, 55 - (int(m.group(2)) - 1) * 5)
+                    self.fichiers.setdefault(cellule, os.path.join(rep, fic))
+        else:
+            if type_fichier == "PO":
+                motif = os.path.join(rep, "[ew][0-9][0-9][0-9]", "[ns][0-9][0-9].dt1")
+            else:
+                motif = os.path.join(rep, "[ew][0-9][0-9][0-9][ns][0-9][0-9]*.shp")
+            for fic in glob.glob(motif):
+                m = re.search(r"([ew])(\d{3})/?([ns])(\d{2})[^/]*$", fic)
+                x = int(m.group(2)) * (1 if m.group(1) == "e" else -1)
+                y = int(m.group(4)) * (1 if m.group(3) == "n" else -1)
+                self.fichiers.setdefault((x, y), fic)
+
+    def selection(self, emprises):
+        """Retourne les cellules qui recouvrent les emprises, réparties en (cellules avec fichier, cellules sans fichier)"""
+        liste_cellules = set()
+        for emprise in emprises:
+            liste_cellules.update(cellules(emprise, self.pas))
+        liste_cellules = sorted(liste_cellules)
+        presentes = [c for c in liste_cellules if c in self.fichiers]
+        manquantes = [c for c in liste_cellules if c not in self.fichiers]
+        return presentes, manquantes
+
+
+def fichiers_site(site, rep_mnt_in, rep_swbd, type_mnt):
+    """Emprise en lat/lon des tuiles du site, et listes des fichiers MNT et eau qui la recouvrent, au format de fusion_mnt
+    retourne (emprises, liste_fic_mnt, liste_fic_eau, liste_centre_eau)"""
+    emprises = emprises_latlon(tuiles_site(site), site.EPSG_out)
+
+    # les cellules sans fichier MNT (en mer) sont ignorées, leur altitude sera nulle
+    index_mnt = classe_index_fichiers(rep_mnt_in, type_mnt)
+    (cellules_mnt, manquantes) = index_mnt.selection(emprises)
+    if manquantes:
+        print "WARNING : fichiers MNT absents de", rep_mnt_in, "ignorés :", [NOMS[type_mnt](c) for c in manquantes]
+    liste_fic_mnt = [NOMS[type_mnt](c) for c in cellules_mnt]
+
+    # les cellules sans fichier SWBD sont gardées, elles sont entièrement terre ou mer
+    index_eau = classe_index_fichiers(rep_swbd, "SWBD")
+    (presentes, manquantes) = index_eau.selection(emprises)
+    if manquantes:
+        print "fichiers SWBD absents de", rep_swbd, "(cellules entièrement terre ou mer) :", \
+            [nom_swbd(c) for c in manquantes]
+    cellules_eau = sorted(presentes + manquantes)
+    liste_fic_eau = [nom_swbd(c) for c in cellules_eau]
+    liste_centre_eau = [[x + 0.5, y + 0.5] for (x, y) in cellules_eau]
+    return emprises, liste_fic_mnt, liste_fic_eau, liste_centre_eau
@@ -11,37 +11,87 @@ from osgeo import gdal, ogr, osr
 
 import scipy.ndimage as nd
 
+from lib_footprint import contour_densifie
+
+
+LAND_POLYGONS = "land_polygons_osm/simplified_land_polygons.shp"
+# nombre de cellules de l'index des polygones terre sur la largeur de la couche
+NB_CELLULES_INDEX = 360
+
+
+class classe_index_terre:
+    """Polygones terre du shapefile chargés une seule fois, indexés par cellule d'une grille régulière
+    dans la projection du shapefile"""
+
+    def __init__(self, shapefile=LAND_POLYGONS):
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        dataSource = driver.Open(shapefile, 0)
+        if dataSource is None:
+            raise IOError("impossible d'ouvrir %s" % shapefile)
+        layer = dataSource.GetLayer()
+
+        latlon = osr.SpatialReference()
+        latlon.ImportFromEPSG(4326)
+        targetProj = layer.GetSpatialRef().Clone()
+        # ordre lon, lat avec gdal >= 3
+        if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+            latlon.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            targetProj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.transform = osr.CoordinateTransformation(latlon, targetProj)
+
+        (self.x_min, x_max, self.y_min, y_max) = layer.GetExtent()
+        self.pas = max(x_max - self.x_min, y_max - self.y_min) / NB_CELLULES_INDEX
+        self.geometries = []
+        self.cellules = {}
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            num = len(self.geometries)
+            self.geometries.append(geom.Clone())
+            (gx_min, gx_max, gy_min, gy_max) = geom.GetEnvelope()
+            (i_min, j_min) = self.cellule(gx_min, gy_min)
+            (i_max, j_max) = self.cellule(gx_max, gy_max)
+            for i in range(i_min, i_max + 1):
+                for j in range(j_min, j_max + 1):
+                    self.cellules.setdefault((i, j), []).append(num)
+        dataSource = None
+
+    def cellule(self, x, y):
+        return int((x - self.x_min) // self.pas), int((y - self.y_min) // self.pas)
+
+    def terre(self, points):
+        """Pour une liste de points (lon, lat), retourne la liste des booléens vrais si le point est sur terre"""
+        if len(points) == 0:
+            return []
+        # conversion de tous les points en un seul appel
+        xy = self.transform.TransformPoints([[lon, lat] for (lon, lat) in points])
+        resultats = []
+        for (x, y) in [(p[0], p[1]) for p in xy]:
+            pt = ogr.Geometry(ogr.wkbPoint)
+            pt.SetPoint_2D(0, x, y)
+            land = False
+            for num in self.cellules.get(self.cellule(x, y), []):
+                if self.geometries[num].Contains(pt):
+                    land = True
+                    break
+            resultats.append(land)
+        return resultats
+
+
+# l'index est chargé au premier appel, puis réutilisé
+_index_terre = {}
+
+
+def index_terre(shapefile=LAND_POLYGONS):
+    if shapefile not in _index_terre:
+        _index_terre[shapefile] = classe_index_terre(shapefile)
+    return _index_terre[shapefile]
+
 
 # Returns true if coordinate is land
 def TestLand(lon, lat):
-    latlon = osr.SpatialReference()
-    latlon.ImportFromEPSG(4326)
-
-    # create a point
-
-    pt = ogr.Geometry(ogr.wkbPoint)
-    pt.SetPoint_2D(0, lon, lat)
-
-    # read shapefile
-    shapefile = "land_polygons_osm/simplified_land_polygons.shp"
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    dataSource = driver.Open(shapefile, 0)
-    layer = dataSource.GetLayer()
-    targetProj = layer.GetSpatialRef()
-    land = False
-
-    # conversion to shapefile projection
-    transform = osr.CoordinateTransformation(latlon, targetProj)
-    pt.Transform(transform)
-
-    # search point in layers
-    for feature in layer:
-        geom = feature.GetGeometryRef()
-        if geom.Contains(pt):
-            land = True
-            break
-
-    return land
+    return index_terre().terre([(lon, lat)])[0]
 
 
 ##################################### Lecture de fichier de parametres "Mot_clé=Valeur"
@@ -148,6 +198,49 @@ def lire_entete_mnt(fic_hdr):
 
 
 #################calcule le nom de la tuile
+# mémoire de travail de gdal.Warp, en Mo
+WARP_MEMORY = 512
+# fichiers ouverts une seule fois pour toutes les tuiles : ((date de modification, taille), dataset)
+_sources = {}
+
+
+def ouvre_source(fic):
+    """Ouvre fic avec gdal, ou réutilise le dataset déjà ouvert si le fichier n'a pas été modifié depuis
+    un fichier réécrit par ce programme doit être oublié par ferme_sources, la date peut ne pas avoir changé"""
+    stat = os.stat(fic)
+    signature = (stat.st_mtime, stat.st_size)
+    if fic in _sources and _sources[fic][0] == signature:
+        return _sources[fic][1]
+    ferme_sources([fic])
+    ds = gdal.Open(fic)
+    if ds is None:
+        raise RuntimeError("impossible d'ouvrir %s : %s" % (fic, gdal.GetLastErrorMsg()))
+    _sources[fic] = (signature, ds)
+    return ds
+
+
+def ferme_sources(fichiers=None):
+    """Ferme les datasets ouverts par ouvre_source pour les fichiers de la liste, ou tous"""
+    if fichiers is None:
+        fichiers = list(_sources.keys())
+    for fic in fichiers:
+        if fic in _sources:
+            # le dataset est fermé quand sa dernière référence disparaît
+            del _sources[fic]
+
+
+def warp_tuile(src, fic_out, format, mnt, **options):
+    """Reprojette le dataset src sur l'emprise et la résolution de mnt (classe_mnt), retourne le dataset produit"""
+    opts = gdal.WarpOptions(format=format, xRes=mnt.res, yRes=mnt.res,
+                            outputBounds=(mnt.ulx, mnt.lry, mnt.lrx, mnt.uly), dstSRS=mnt.chaine_proj,
+                            multithread=True, warpMemoryLimit=WARP_MEMORY,
+                            warpOptions=["NUM_THREADS=ALL_CPUS"], **options)
+    ds_out = gdal.Warp(fic_out, src, options=opts)
+    if ds_out is None:
+        raise RuntimeError("gdal.Warp %s -> %s : %s" % (src.GetDescription(), fic_out, gdal.GetLastErrorMsg()))
+    return ds_out
+
+
 def calcule_nom_tuile(tx, ty, site, nom_site):
     if tx >= 0:
         GD = "D"
@@ -215,112 +308,10 @@ class classe_mnt:
     ########################Interface GDAL#######################
     #############################################################
 
-    def decoupe_float(self, fic_in, fic_out):
-        # calcul du mnt float
-        chaine_etendue = str(self.ulx) + ' ' + str(self.lry) + ' ' + str(self.lrx) + ' ' + str(self.uly)
-        commande = 'gdalwarp  -overwrite -r cubic -ot Float32 -srcnodata -32768 -dstnodata 0 -of ENVI -tr %d %d -te %s -t_srs %s %s %s\n' % (
-        self.res, self.res, chaine_etendue, self.chaine_proj, fic_in, fic_out)
-        print commande
-        os.system(commande)
-
-    def decoupe_int(self, fic_in, fic_out):
-        # calcul du mnt int
-        chaine_etendue = str(self.ulx) + ' ' + str(self.lry) + ' ' + str(self.lrx) + ' ' + str(self.uly)
-        commande = 'gdalwarp  -overwrite -r cubic -srcnodata -32768 -dstnodata 0 -of ENVI -tr %d %d -te %s -t_srs %s %s %s\n' % (
-        self.res, self.res, chaine_etendue, self.chaine_proj, fic_in, fic_out)
-        print commande
-        os.system(commande)
-
-    #############################################################
-    ########################Decoupage MNT########################
-    #############################################################
-
-    def decoupe(self, mnt_in):
-        print "###decoupage " + str(self.res) + 'm'
-        rac_mnt = self.racine + '_' + str(self.res) + 'm'
-        fic_hdr_mnt = rac_mnt + '.hdr'
-        fic_mnt = rac_mnt + '.mnt'
-        fic_hdr_mnt_float = rac_mnt + 'float.hdr'
-        fic_mnt_float = rac_mnt + 'float.mnt'
-
-        # calcul du mnt int
-        self.decoupe_int(mnt_in, fic_mnt)
-
-        # calcul du mnt float
-        self.decoupe_float(mnt_in, fic_mnt_float)
-
-        # ecriture des entetes babel
-        (nblig, nbcol, type_donnee, endian) = lire_entete_mnt(fic_hdr_mnt)
-
-        self.ecrit_hd(nblig, nbcol)
-        self.ecrit_hd_babel(nblig, nbcol)
-
-        shutil.copy(fic_mnt, rac_mnt + '.c1')
-
-    #############################################################
-    ########################Reech gradient########################
-    #############################################################
-
-    def reech_gradient(self, fic_dz_dl_srtm, fic_dz_dc_srtm):
-        rac_mnt = self.racine + '_' + str(self.res) + 'm'
-        fic_dz_dl = rac_mnt + 'float.dz_dl'
-        fic_dz_dc = rac_mnt + 'float.dz_dc'
-
-        # rééch
-        self.decoupe_float(fic_dz_dl_srtm, fic_dz_dl)
-        self.decoupe_float(fic_dz_dc_srtm, fic_dz_dc)
-
-    ###########################################################
-    ######### calcul du gradient################################
-    ###########################################################
-
-    def calcul_gradient(self):
-        rac_mnt = self.racine + '_' + str(self.res) + 'm'
-        print rac_mnt
-        fic_mnt = rac_mnt + 'float.mnt'
-        fic_hdr = rac_mnt + 'float.hdr'
-        fic_dz_dl = rac_mnt + 'float.dz_dl'
-        fic_dz_dc = rac_mnt + 'float.dz_dc'
-        (nblig, nbcol, type_donnee, endian) = lire_entete_mnt(fic_hdr)
-
-        srtm = (np.fromfile(fic_mnt, type_donnee)).reshape(nblig, nbcol)
-        Noyau_horizontal = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-        Noyau_vertical = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
-
-        dz_dc = nd.convolve(srtm, Noyau_horizontal) / 8. / self.res
-        dz_dl = nd.convolve(srtm, Noyau_vertical) / 8. / self.res
-
-        dz_dl.tofile(fic_dz_dl)
-        dz_dc.tofile(fic_dz_dc)
-        return (fic_dz_dl, fic_dz_dc)
-
-    #############################################################
-    ########################Calcul_pentes########################
-    #############################################################
-
-    def calcul_pente_aspect_fic(self):
-        rac_mnt = self.racine + '_' + str(self.res) + 'm'
-        print rac_mnt
-
-        fic_hdr = rac_mnt + 'float.hdr'
-        fic_dz_dl = rac_mnt + 'float.dz_dl'
-        fic_dz_dc = rac_mnt + 'float.dz_dc'
-
-        (nblig, nbcol, type_donnee, endian) = lire_entete_mnt(fic_hdr)
-        print nblig * nbcol * 2
-        # dz_dl=(np.fromfile(fic_dz_dl,type_donnee)).reshape(nblig,nbcol).astype('int16')
-        # dz_dc=(np.fromfile(fic_dz_dc,type_donnee)).reshape(nblig,nbcol).astype('int16')
-
-        dz_dl = (np.fromfile(fic_dz_dl, type_donnee)).reshape(nblig, nbcol)
-        dz_dc = (np.fromfile(fic_dz_dc, type_donnee)).reshape(nblig, nbcol)
-
-        norme = np.sqrt((dz_dc) * (dz_dc) + (dz_dl) * (dz_dl))
-        slope = np.arctan(norme)
-        aspect = np.where(dz_dc > 0, np.arccos(dz_dl / norme), 2 * np.pi - np.arccos(dz_dl / norme))
-        aspect = np.where(slope == 0, 0, aspect)
-
-        (slope * 100.).astype('int16').tofile(rac_mnt + '.slope')
-        (aspect * 100.).astype('int16').tofile(rac_mnt + '.aspect')
+    def warp(self, fic_in, fic_out, **options):
+        # reprojection et découpage sur l'emprise de la tuile, dans le processus courant
+        print "###gdal.Warp", fic_in, fic_out, self.res, self.chaine_proj, options
+        warp_tuile(ouvre_source(fic_in), fic_out, "ENVI", self, **options)
 
     #############################################################
     ########################Calcul_eau_mnt#######################
@@ -358,23 +349,392 @@ class classe_mnt:
         fic_hdr_eau = rac_eau + '.hdr'
         fic_eau = rac_eau + '.eau'
 
-        # calcul du mnt int
-        chaine_etendue = str(self.ulx) + ' ' + str(self.lry) + ' ' + str(self.lrx) + ' ' + str(self.uly)
-        commande = 'gdalwarp -overwrite  -r near -of ENVI -tr %d %d -te %s -t_srs %s %s %s\n' % (
-        self.res, self.res, chaine_etendue, self.chaine_proj, eau_in, fic_eau)
-        print commande
-        os.system(commande)
+        # calcul du masque d'eau
+        self.warp(eau_in, fic_eau, resampleAlg="near")
+
+
+#################################################################################
+########################### Pyramide multi-résolution ###########################
+#################################################################################
+# marge en pixels de la fenêtre lue dans la mosaïque, pour le noyau du rééchantillonnage cubique
+MARGE_FENETRE = 4
+
+
+def fenetre_source(fic_in, ulx, uly, lrx, lry, chaine_proj):
+    """Lit en mémoire la fenêtre de fic_in qui recouvre le rectangle (ulx, uly, lrx, lry) exprimé dans chaine_proj
+    les pixels de la source sont conservés, sans rééchantillonnage"""
+    ds = ouvre_source(fic_in)
+    proj_src = osr.SpatialReference()
+    proj_src.ImportFromWkt(ds.GetProjection())
+    proj_tuile = osr.SpatialReference()
+    proj_tuile.SetFromUserInput(chaine_proj)
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        proj_src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        proj_tuile.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    (xs, ys) = contour_densifie(ulx, uly, lrx, lry)
+    points = np.array(osr.CoordinateTransformation(proj_tuile, proj_src).TransformPoints(
+        np.column_stack([xs, ys]).tolist()))
+
+    # emprise en pixels de la source
+    inv_gt = gdal.InvGeoTransform(ds.GetGeoTransform())
+    if len(inv_gt) == 2:  # gdal < 3
+        inv_gt = inv_gt[1]
+    cols = inv_gt[0] + inv_gt[1] * points[:, 0] + inv_gt[2] * points[:, 1]
+    ligs = inv_gt[3] + inv_gt[4] * points[:, 0] + inv_gt[5] * points[:, 1]
+    col_min = max(0, int(np.floor(cols.min())) - MARGE_FENETRE)
+    lig_min = max(0, int(np.floor(ligs.min())) - MARGE_FENETRE)
+    col_max = min(ds.RasterXSize, int(np.ceil(cols.max())) + MARGE_FENETRE)
+    lig_max = min(ds.RasterYSize, int(np.ceil(ligs.max())) + MARGE_FENETRE)
+    if col_max <= col_min or lig_max <= lig_min:
+        raise RuntimeError("la tuile n'intersecte pas %s" % fic_in)
+
+    print "###lecture de la fenetre", col_min, lig_min, col_max - col_min, lig_max - lig_min, "de", fic_in
+    fenetre = gdal.Translate("", ds, format="MEM", srcWin=[col_min, lig_min, col_max - col_min, lig_max - lig_min])
+    if fenetre is None:
+        raise RuntimeError("lecture de %s : %s" % (fic_in, gdal.GetLastErrorMsg()))
+    return fenetre
+
+
+def dataset_memoire(mnt, tableaux):
+    """Dataset MEM Float32 sur la grille de mnt (classe_mnt), une bande par tableau"""
+    (nblig, nbcol) = tableaux[0].shape
+    ds = gdal.GetDriverByName("MEM").Create("", nbcol, nblig, len(tableaux), gdal.GDT_Float32)
+    ds.SetGeoTransform((mnt.ulx, mnt.res, 0, mnt.uly, 0, -mnt.res))
+    proj = osr.SpatialReference()
+    proj.SetFromUserInput(mnt.chaine_proj)
+    ds.SetProjection(proj.ExportToWkt())
+    for (i, tableau) in enumerate(tableaux):
+        ds.GetRasterBand(i + 1).WriteArray(tableau)
+    return ds
+
+
+MODES_GRADIENT = ["reech", "local", "cache"]
+OPTIONS_ALTITUDE = {"resampleAlg": "cubic", "outputType": gdal.GDT_Float32, "srcNodata": -32768, "dstNodata": 0}
+OPTIONS_GRADIENT = {"resampleAlg": "cubic", "srcNodata": -32768, "dstNodata": 0}
+
+
+def taille_grille(mnt):
+    """Nombre de lignes et de colonnes de la grille de mnt (classe_mnt), arrondis comme par gdal.Warp"""
+    nbcol = int((mnt.lrx - mnt.ulx) / float(mnt.res) + 0.5)
+    nblig = int((mnt.uly - mnt.lry) / float(mnt.res) + 0.5)
+    return nblig, nbcol
+
+
+def lignes_warp(source, mnt, l0, l1, **options):
+    """Lignes [l0, l1[ du rééchantillonnage du dataset source sur la grille de mnt (classe_mnt), seules ces lignes
+    sont calculées. Retourne un tableau (lignes, colonnes), ou (bandes, lignes, colonnes) si source a plusieurs bandes
+    La transformation est exacte (errorThreshold=0) : l'approximation par défaut de gdal.Warp dépend de la fenêtre,
+    et les bords des blocs différeraient du rééchantillonnage de la tuile entière"""
+    options.setdefault("errorThreshold", 0)
+    fenetre = classe_mnt("", "", mnt.ulx, mnt.uly - l0 * mnt.res, mnt.lrx, mnt.uly - l1 * mnt.res, mnt.res,
+                         mnt.chaine_proj)
+    ds = warp_tuile(source, "", "MEM", fenetre, **options)
+    lignes = ds.ReadAsArray()
+    ds = None
+    return lignes
+
+
+def altitude_tuile(source, mnt):
+    """Mnt float de toute la tuile mnt (classe_mnt), utilisé seulement à la résolution du gradient (90m)"""
+    return lignes_warp(source, mnt, 0, taille_grille(mnt)[0], **OPTIONS_ALTITUDE)
+
+
+def cree_envi(fichier, mnt, nblig, nbcol, type_gdal):
+    # fichier ENVI sur la grille de mnt (classe_mnt), rempli ensuite par blocs de lignes
+    ds = gdal.GetDriverByName("ENVI").Create(fichier, nbcol, nblig, 1, type_gdal)
+    if ds is None:
+        raise RuntimeError("création de %s : %s" % (fichier, gdal.GetLastErrorMsg()))
+    ds.SetGeoTransform((mnt.ulx, mnt.res, 0, mnt.uly, 0, -mnt.res))
+    proj = osr.SpatialReference()
+    proj.SetFromUserInput(mnt.chaine_proj)
+    ds.SetProjection(proj.ExportToWkt())
+    ds.GetRasterBand(1).SetNoDataValue(0)
+    return ds
+
+
+############################ Lecture des blocs de lignes de la pyramide
+# altitude : fonction (a, b) qui retourne les lignes [a, b[ du mnt float
+# gradient : fonction (altitude des lignes [a, b[, a, b, l0, l1) qui retourne les lignes [l0, l1[ de dz_dl et dz_dc
+
+def altitude_tableau(altitude):
+    return lambda a, b: altitude[a:b]
+
+
+def altitude_warp(source, mnt):
+    return lambda a, b: lignes_warp(source, mnt, a, b, **OPTIONS_ALTITUDE)
+
+
+def gradient_tableaux(dz_dl, dz_dc):
+    return lambda altitude, a, b, l0, l1: (dz_dl[l0:l1], dz_dc[l0:l1])
+
+
+def gradient_warp(gradients, mnt):
+    # gradients rééchantillonnés depuis un dataset à deux bandes (dz_dl, dz_dc)
+    def lignes(altitude, a, b, l0, l1):
+        bandes = lignes_warp(gradients, mnt, l0, l1, **OPTIONS_GRADIENT)
+        return bandes[0], bandes[1]
+    return lignes
+
+
+def gradient_sobel(res):
+    # gradients calculés sur l'altitude des lignes [a, b[, qui comprend une ligne de halo
+    def lignes(altitude, a, b, l0, l1):
+        (dz_dl, dz_dc) = gradient(altitude, res)
+        return dz_dl[l0 - a:l1 - a], dz_dc[l0 - a:l1 - a]
+    return lignes
+
+
+class classe_cache_gradient:
+    """Gradient calculé une seule fois sur l'emprise d'un site, puis réutilisé par toutes ses tuiles
+    mnt_site est une classe_mnt qui couvre le site, à la résolution du gradient"""
+
+    def __init__(self, mnt_site):
+        self.mnt_site = mnt_site
+        self.datasets = {}
+
+    def gradients(self, mnt_in):
+        if mnt_in not in self.datasets:
+            mnt = self.mnt_site
+            print "###gradient du site à " + str(mnt.res) + 'm'
+            source = fenetre_source(mnt_in, mnt.ulx, mnt.uly, mnt.lrx, mnt.lry, mnt.chaine_proj)
+            (dz_dl, dz_dc) = gradient(altitude_tuile(source, mnt), mnt.res)
+            self.datasets[mnt_in] = dataset_memoire(mnt, [dz_dl, dz_dc])
+        return self.datasets[mnt_in]
+
+
+class classe_pyramide_mnt:
+    """MNT d'une tuile à plusieurs résolutions, calculés en une passe à partir d'une seule lecture de la mosaïque
+
+    niveaux est la liste des classe_mnt à produire. Selon mode_gradient, les gradients de chaque niveau sont :
+     - reech : calculés au niveau de résolution res_gradient puis rééchantillonnés aux autres niveaux
+     - local : calculés par le filtre de Sobel sur le mnt rééchantillonné de chaque niveau, sans warp supplémentaire
+     - cache : rééchantillonnés depuis le gradient du site calculé une fois par cache (classe_cache_gradient)
+    Pour chaque niveau sont écrits le mnt entier (.mnt, .hdr, .c1, .hd, .hd_babel), la pente (.slope) et
+    l'orientation (.aspect). Le mnt float et les gradients (float.mnt, float.dz_dl, float.dz_dc) ne sont écrits que
+    pour les résolutions de res_intermediaires.
+
+    Chaque niveau est rééchantillonné, traité et écrit par blocs de LIGNES_BLOC lignes : seuls le mnt et les
+    gradients à res_gradient sont gardés en entier en mémoire."""
+
+    def __init__(self, niveaux, res_gradient, mode_gradient="reech", cache=None):
+        if mode_gradient not in MODES_GRADIENT:
+            raise ValueError("mode de gradient inconnu %s" % mode_gradient)
+        if mode_gradient == "cache" and (cache is None or cache.mnt_site.res != res_gradient):
+            raise ValueError("le mode cache nécessite un cache de gradient à %sm" % res_gradient)
+        self.niveaux = niveaux
+        self.res_gradient = res_gradient
+        self.niveau_gradient = [mnt for mnt in niveaux if mnt.res == res_gradient][0]
+        self.mode_gradient = mode_gradient
+        self.cache = cache
+
+    def construit(self, mnt_in, res_intermediaires=()):
+        # emprise commune à tous les niveaux
+        ulx = min([mnt.ulx for mnt in self.niveaux])
+        uly = max([mnt.uly for mnt in self.niveaux])
+        lrx = max([mnt.lrx for mnt in self.niveaux])
+        lry = min([mnt.lry for mnt in self.niveaux])
+        source = fenetre_source(mnt_in, ulx, uly, lrx, lry, self.niveau_gradient.chaine_proj)
+
+        gradients = None
+        if self.mode_gradient == "reech":
+            # gradient à la résolution res_gradient
+            mnt = self.niveau_gradient
+            altitude_gradient = altitude_tuile(source, mnt)
+            (dz_dl, dz_dc) = gradient(altitude_gradient, mnt.res)
+            gradients = dataset_memoire(mnt, [dz_dl, dz_dc])
+        elif self.mode_gradient == "cache":
+            gradients = self.cache.gradients(mnt_in)
+
+        for mnt in self.niveaux:
+            print "###pyramide " + str(mnt.res) + 'm', self.mode_gradient
+            halo = 0
+            if self.mode_gradient == "reech" and mnt is self.niveau_gradient:
+                lignes_altitude = altitude_tableau(altitude_gradient)
+                lignes_gradient = gradient_tableaux(dz_dl, dz_dc)
+            else:
+                lignes_altitude = altitude_warp(source, mnt)
+                if gradients is None:
+                    halo = 1
+                    lignes_gradient = gradient_sobel(mnt.res)
+                else:
+                    lignes_gradient = gradient_warp(gradients, mnt)
+            self.ecrit(mnt, lignes_altitude, lignes_gradient, halo, mnt.res in res_intermediaires)
+
+    def ecrit(self, mnt, lignes_altitude, lignes_gradient, halo, intermediaires):
+        rac_mnt = mnt.racine + '_' + str(mnt.res) + 'm'
+        (nblig, nbcol) = taille_grille(mnt)
+
+        # fichiers ENVI, écrits bloc par bloc
+        ds_int = cree_envi(rac_mnt + '.mnt', mnt, nblig, nbcol, gdal.GDT_Int16)
+        ds_float = None
+        if intermediaires:
+            ds_float = cree_envi(rac_mnt + 'float.mnt', mnt, nblig, nbcol, gdal.GDT_Float32)
+        fichiers = [open(rac_mnt + '.slope', 'wb'), open(rac_mnt + '.aspect', 'wb')]
+        if intermediaires:
+            fichiers += [open(rac_mnt + 'float.dz_dl', 'wb'), open(rac_mnt + 'float.dz_dc', 'wb')]
+
+        lignes_bloc = min(LIGNES_BLOC, nblig)
+        noyau = classe_noyau_pente_aspect(lignes_bloc, nbcol)
+        arrondi = np.empty((lignes_bloc, nbcol), np.float32)
+        altitude_int = np.empty((lignes_bloc, nbcol), 'int16')
+        try:
+            for (a, b, l0, l1) in blocs_lignes(nblig, halo):
+                altitude = lignes_altitude(a, b)
+                (dz_dl, dz_dc) = lignes_gradient(altitude, a, b, l0, l1)
+                altitude = altitude[l0 - a:l1 - a]
+                n = l1 - l0
+
+                # le mnt entier est l'arrondi du mnt float
+                np.rint(altitude, out=arrondi[:n])
+                np.clip(arrondi[:n], -32768, 32767, out=arrondi[:n])
+                np.copyto(altitude_int[:n], arrondi[:n], casting='unsafe')
+                ds_int.GetRasterBand(1).WriteArray(altitude_int[:n], 0, l0)
+                if ds_float is not None:
+                    ds_float.GetRasterBand(1).WriteArray(altitude, 0, l0)
+
+                (slope, aspect) = noyau.calcule(dz_dl, dz_dc)
+                slope.tofile(fichiers[0])
+                aspect.tofile(fichiers[1])
+                if intermediaires:
+                    dz_dl.astype('float32').tofile(fichiers[2])
+                    dz_dc.astype('float32').tofile(fichiers[3])
+        finally:
+            for f in fichiers:
+                f.close()
+            ds_int = None
+            ds_float = None
+
+        shutil.copy(rac_mnt + '.mnt', rac_mnt + '.c1')
+        mnt.ecrit_hd(nblig, nbcol)
+        mnt.ecrit_hd_babel(nblig, nbcol)
+
+
+#################################################################################
+########################### Traitement par blocs de lignes ######################
+#################################################################################
+# nombre de lignes des blocs, soit environ 45 Mo par tableau float32 pour une tuile S2 à 10m
+LIGNES_BLOC = 1024
+
+
+def blocs_lignes(nblig, halo, lignes_bloc=LIGNES_BLOC):
+    """Blocs de lignes [l0, l1[ d'une image, avec halo lignes de recouvrement de part et d'autre
+    retourne (début de lecture, fin de lecture, l0, l1)"""
+    for l0 in range(0, nblig, lignes_bloc):
+        l1 = min(nblig, l0 + lignes_bloc)
+        yield max(0, l0 - halo), min(nblig, l1 + halo), l0, l1
+
+
+def pente_aspect_blocs(dz_dl, dz_dc, fic_slope, fic_aspect, type_calcul=np.float32):
+    """Pente et orientation en centièmes de radian (int16), par blocs de lignes"""
+    noyau = classe_noyau_pente_aspect(min(LIGNES_BLOC, dz_dl.shape[0]), dz_dl.shape[1], type_calcul)
+    with open(fic_slope, 'wb') as f_slope, open(fic_aspect, 'wb') as f_aspect:
+        for (a, b, l0, l1) in blocs_lignes(dz_dl.shape[0], 0):
+            (slope, aspect) = noyau.calcule(np.asarray(dz_dl[l0:l1]), np.asarray(dz_dc[l0:l1]))
+            slope.tofile(f_slope)
+            aspect.tofile(f_aspect)
+
+
+class classe_noyau_pente_aspect:
+    """Calcul de la pente et de l'orientation en centièmes de radian (int16), en une passe sur des tableaux
+    alloués une seule fois pour des blocs d'au plus nblig lignes, avec des calculs intermédiaires en type_calcul
+
+    Les pixels de norme nulle ont une orientation nulle, les pixels non finis une pente et une orientation nulles
+    Les gradients étant en float32, les calculs d'origine étaient faits en float32 : avec type_calcul float32, les
+    int16 produits leur sont identiques (tolérance 0, vérifiée par bench_pente_aspect.py), alors qu'en float64 ils
+    peuvent différer d'un centième de radian"""
+
+    def __init__(self, nblig, nbcol, type_calcul=np.float32):
+        self.type_calcul = type_calcul
+        self.norme = np.empty((nblig, nbcol), type_calcul)
+        self.calcul = np.empty((nblig, nbcol), type_calcul)
+        self.masque = np.empty((nblig, nbcol), bool)
+        self.masque_norme = np.empty((nblig, nbcol), bool)
+        self.slope = np.empty((nblig, nbcol), 'int16')
+        self.aspect = np.empty((nblig, nbcol), 'int16')
+
+    def calcule(self, dz_dl, dz_dc):
+        """Retourne (slope, aspect) en int16, vues sur les tableaux du noyau valables jusqu'au prochain appel"""
+        n = dz_dl.shape[0]
+        norme = self.norme[:n]
+        calcul = self.calcul[:n]
+        masque = self.masque[:n]
+        masque_norme = self.masque_norme[:n]
+        slope = self.slope[:n]
+        aspect = self.aspect[:n]
+        t = self.type_calcul
+
+        # norme du gradient
+        np.multiply(dz_dc, dz_dc, out=norme, dtype=t)
+        np.multiply(dz_dl, dz_dl, out=calcul, dtype=t)
+        np.add(norme, calcul, out=norme)
+        np.sqrt(norme, out=norme)
+
+        # orientation : arccos(dz_dl / norme), ou 2 pi - arccos(dz_dl / norme) si dz_dc <= 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(dz_dl, norme, out=calcul, dtype=t)
+            np.clip(calcul, -1, 1, out=calcul)
+            np.arccos(calcul, out=calcul)
+            np.greater(dz_dc, 0, out=masque)
+            np.logical_not(masque, out=masque)
+            np.subtract(t(2 * np.pi), calcul, out=calcul, where=masque)
+        # orientation nulle si la pente est nulle, ou si la valeur n'est pas finie
+        np.isfinite(calcul, out=masque)
+        np.not_equal(norme, 0, out=masque_norme)
+        np.logical_and(masque, masque_norme, out=masque)
+        np.logical_not(masque, out=masque)
+        np.multiply(calcul, 100, out=calcul)
+        np.copyto(calcul, 0, where=masque)
+        np.copyto(aspect, calcul, casting='unsafe')
+
+        # pente
+        np.arctan(norme, out=norme)
+        np.isfinite(norme, out=masque)
+        np.logical_not(masque, out=masque)
+        np.multiply(norme, 100, out=norme)
+        np.copyto(norme, 0, where=masque)
+        np.copyto(slope, norme, casting='unsafe')
+        return slope, aspect
+
+
+def gradient(altitude, res):
+    """Gradients en ligne et en colonne d'un mnt, par le filtre de Sobel (bords réfléchis)"""
+    Noyau_horizontal = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
+    Noyau_vertical = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    dz_dc = nd.convolve(altitude, Noyau_horizontal) / 8. / res
+    dz_dl = nd.convolve(altitude, Noyau_vertical) / 8. / res
+    return dz_dl, dz_dc
 
 
 #################################################################################
 ########################### Fusion DEM and water masks   ########################
 #################################################################################
-def fusion_mnt(liste_fic_mnt, liste_fic_eau, liste_centre_eau, rep_mnt, rep_swbd, nom_site, calcul_eau_mnt, working_dir=None):
-    if working_dir is None:
-        working_dir = tempfile.mkdtemp(prefix="{}_".format(nom_site))
-    else:
-        working_dir = tempfile.mkdtemp(prefix="{}_".format(nom_site), dir=working_dir)
-    print "liste_fic_mnt", liste_fic_mnt
+def mosaique_vrt(liste_fic_mnt, rep_mnt, nom_vrt):
+    """Mosaïque virtuelle des fichiers MNT, sans copie : les fichiers zippés sont lus par /vsizip/
+    et les pixels à -32767 deviennent 0, comme dans le mnt nodata0 de fusion_mnt_tif
+    les fichiers absents (cellules en mer) sont ignorés, la valeur de la mosaïque y est 0"""
+    sources = []
+    for fic in liste_fic_mnt:
+        fichier = os.path.join(rep_mnt, fic)
+        if not os.path.exists(fichier):
+            ficzip = fichier.replace('tif', 'zip')
+            if not os.path.exists(ficzip):
+                print "WARNING : fichier MNT absent, ignoré :", fichier
+                continue
+            fichier = "/vsizip/" + ficzip + "/" + os.path.basename(fic)
+        sources.append(fichier)
+    if len(sources) == 0:
+        raise IOError("aucun fichier MNT dans %s parmi %s" % (rep_mnt, liste_fic_mnt))
+    print "###gdal.BuildVRT", nom_vrt, sources
+    # VRTNodata est aussi la valeur des zones sans fichier source
+    ds = gdal.BuildVRT(nom_vrt, sources, srcNodata=-32767, VRTNodata=0)
+    if ds is None:
+        raise RuntimeError("gdal.BuildVRT %s : %s" % (nom_vrt, gdal.GetLastErrorMsg()))
+    ds = None
+    return nom_vrt
+
+
+def fusion_mnt_tif(liste_fic_mnt, rep_mnt, nom_site, working_dir):
+    # mosaïque GeoTIFF des fichiers MNT, puis sa copie avec no_data=0
     for fic in liste_fic_mnt:
         print rep_mnt + '/' + fic
         if not (os.path.exists(rep_mnt + '/' + fic)):
@@ -402,37 +762,59 @@ def fusion_mnt(liste_fic_mnt, liste_fic_eau, liste_centre_eau, rep_mnt, rep_swbd
     commande = 'gdalwarp  -r cubic -srcnodata -32767 -dstnodata 0  %s %s\n' % (nom_mnt, nom_mnt_nodata0)
     print commande
     os.system(commande)
+    return nom_mnt, nom_mnt_nodata0
+
+
+def fusion_mnt(liste_fic_mnt, liste_fic_eau, liste_centre_eau, rep_mnt, rep_swbd, nom_site, calcul_eau_mnt, working_dir=None,
+               vrt=False):
+    """Fusion des fichiers MNT et des masques d'eau SWBD du site
+    avec vrt, le mnt est une mosaïque virtuelle des fichiers MNT, lue par fenêtres lors du découpage des tuiles"""
+    if working_dir is None:
+        working_dir = tempfile.mkdtemp(prefix="{}_".format(nom_site))
+    else:
+        working_dir = tempfile.mkdtemp(prefix="{}_".format(nom_site), dir=working_dir)
+    print "liste_fic_mnt", liste_fic_mnt
+    if vrt and len(liste_fic_mnt) > 0:
+        nom_mnt = mosaique_vrt(liste_fic_mnt, rep_mnt, os.path.join(working_dir, "mnt_{}.vrt".format(nom_site)))
+        nom_mnt_nodata0 = nom_mnt
+    else:
+        (nom_mnt, nom_mnt_nodata0) = fusion_mnt_tif(liste_fic_mnt, rep_mnt, nom_site, working_dir)
 
     if calcul_eau_mnt == 0:  # si on est en deça de 60°N
 
         # Création d'un fichier vide (valeurs à 0) avec la même emprise que le mnt fusionnné
         ####################################################################################
-        nom_raster_swbd = os.path.join(working_dir, os.path.basename(nom_mnt).split('.tif')[0] + "_tmp.tif")
+        nom_raster_swbd = os.path.join(working_dir, os.path.splitext(os.path.basename(nom_mnt))[0] + "_tmp.tif")
         if os.path.exists(nom_raster_swbd):
             os.remove(nom_raster_swbd)
+        # un nouveau GeoTIFF est initialisé à 0, le mnt n'est pas relu
         ds = gdal.Open(nom_mnt)
         driver = gdal.GetDriverByName('GTiff')
-        ds_out = driver.CreateCopy(nom_raster_swbd, ds, 0)
         inband = ds.GetRasterBand(1)
-        outband = ds_out.GetRasterBand(1)
-        for i in range(inband.YSize - 1, -1, -1):
-            scanline = inband.ReadAsArray(0, i, inband.XSize, 1, inband.XSize, 1)
-            scanline = scanline * 0
-            outband.WriteArray(scanline, 0, i)
+        ds_out = driver.Create(nom_raster_swbd, ds.RasterXSize, ds.RasterYSize, 1, inband.DataType)
+        ds_out.SetGeoTransform(ds.GetGeoTransform())
+        ds_out.SetProjection(ds.GetProjection())
         ds_out = None
+        ds = None
 
         # remplissage de ce fichier avec les fichiers SWBD
         liste_tuiles_manquantes = ["e017n03", "e006n30", "e006n29", "e005n30", "e005n29", "e015n00", "e015s24",
                                    "e022n28", "e023n28", "w074n01", "e034n02", "e035n02"]
+        liste_shp = [glob.glob(rep_swbd + '/' + racine_nom_eau + "*.shp") for racine_nom_eau in liste_fic_eau]
+        # test if the centers of the cells without SWBD file are water or land, in one call
+        manquants = [i for i in range(len(liste_fic_eau)) if len(liste_shp[i]) == 0]
+        terre = {}
+        if manquants:
+            tests = index_terre().terre([liste_centre_eau[i] for i in manquants])
+            terre = dict(zip(manquants, tests))
         for i, racine_nom_eau in enumerate(liste_fic_eau):
             print racine_nom_eau
-            shp = glob.glob(rep_swbd + '/' + racine_nom_eau + "*.shp")
+            shp = liste_shp[i]
             # if shp file does not exist
             if len(shp) == 0:
                 print 'missing SWBD watr file : ', racine_nom_eau
 
-                # test if center is water or land
-                land = TestLand(liste_centre_eau[i][0], liste_centre_eau[i][1])
+                land = terre[i]
                 if land:
                     valeur = 0
                     print "it is a fully land tile"
@@ -454,21 +836,15 @@ def fusion_mnt(liste_fic_mnt, liste_fic_eau, liste_centre_eau, rep_mnt, rep_swbd
             os.system(commande)
     else:
         nom_raster_swbd = ""
+    # les fichiers écrits ici peuvent avoir été ouverts auparavant avec le même nom
+    ferme_sources([nom_mnt, nom_mnt_nodata0, nom_raster_swbd])
     return nom_mnt_nodata0, nom_raster_swbd
 
 
 # calcul de pentes et aspect
 ##########################
-def calcul_pente_aspect_mem(rac_mnt, dz_dc, dz_dl):
-    norme = np.sqrt((dz_dc) * (dz_dc) + (dz_dl) * (dz_dl))
-    slope = np.arctan(norme)
-    aspect = np.where(dz_dc > 0, np.arccos(dz_dl / norme), 2 * np.pi - np.arccos(dz_dl / norme))
-    aspect = np.where(slope == 0, 0, aspect)
-    slope = np.where(np.isfinite(slope), slope, 0)
-    aspect = np.where(np.isfinite(aspect), aspect, 0)
-
-    (slope * 100.).astype('int16').tofile(rac_mnt + '.slope')
-    (aspect * 100.).astype('int16').tofile(rac_mnt + '.aspect')
+def calcul_pente_aspect_mem(rac_mnt, dz_dc, dz_dl, type_calcul=np.float32):
+    pente_aspect_blocs(dz_dl, dz_dc, rac_mnt + '.slope', rac_mnt + '.aspect', type_calcul)
 
 
 ##############################################
@@ -24,8 +24,8 @@ class OptionParser(optparse.OptionParser):
 
 from math import ceil, floor
 from lib_mnt import *
+from lib_footprint import fichiers_site
 
-from osgeo import osr
 import sys
 
 os.environ['LC_NUMERIC'] = 'C'
@@ -45,6 +45,9 @@ else:
     parser = OptionParser(usage=usage)
     parser.set_defaults(eau_seulement=False)
     parser.set_defaults(sans_numero=False)
+    parser.set_defaults(intermediaires=False)
+    parser.set_defaults(mode_gradient="reech")
+    parser.set_defaults(vrt=False)
 
     parser.add_option("-p", "--parametre", dest="fic_param", action="store", type="string", \
                       help="fichier de parametre", default=None)
@@ -60,6 +63,13 @@ else:
                       help="Traitement des masques d'eau seulement")
     parser.add_option("-n", dest="sans_numero", action="store_true", \
                       help="Traitement sans numero de tuile")
+    parser.add_option("-i", dest="intermediaires", action="store_true", \
+                      help="Ecrit aussi les fichiers intermediaires (mnt float et gradients) a toutes les resolutions")
+    parser.add_option("-g", dest="mode_gradient", action="store", type="choice", choices=MODES_GRADIENT, \
+                      help="Gradients : reech (reechantillonnes depuis 90m), local (calcules a chaque resolution) " \
+                           "ou cache (90m calcules une fois pour tout le site)")
+    parser.add_option("-v", "--vrt", dest="vrt", action="store_true", \
+                      help="Mosaique virtuelle (VRT) des fichiers MNT, sans fusion ni copie")
 
     (options, args) = parser.parse_args()
     parser.check_required("-p")
@@ -73,115 +83,47 @@ else:
 site = lire_fichier_site(options.fic_site)
 SRTM_RES = 90
 
-# ==========création de la liste des fichiers planet_observer
-# conversion des coordonnées des coins en lat_lon
-latlon = osr.SpatialReference()
-latlon.SetWellKnownGeogCS("WGS84")
-proj_site = osr.SpatialReference()
-proj_site.ImportFromEPSG(site.EPSG_out)
-transform = osr.CoordinateTransformation(proj_site, latlon)
-
-# recherche des 4 coins du site
-ulx_site = site.orig_x + site.tx_min * site.pas_x  # upper left
-uly_site = site.orig_y + site.ty_max * site.pas_y
-lrx_site = site.orig_x + (site.tx_max + 1) * site.pas_x + site.marge  # lower left
-lry_site = site.orig_y + (site.ty_min - 1) * site.pas_y - site.marge
-
-ul_latlon = transform.TransformPoint(ulx_site, uly_site, 0)
-lr_latlon = transform.TransformPoint(lrx_site, lry_site, 0)
-
-liste_fic_mnt = []
-
-############# MNT SRTM du CGIAR
-if options.mnt == "SRTM":
-    # liste des fichiers SRTM nécessaires
-    if (ul_latlon[1]) > 60 or (lr_latlon[1] > 60):
-        print "#################################################"
-        print "latitude supérieure à 60 degrés, pas de donnees SRTM"
-        print "#################################################"
-        sys.exit(-3)
-
-    ul_latlon_srtm = [int(ul_latlon[0] + 180) / 5 + 1, int(60 - ul_latlon[1]) / 5 + 1]
-    lr_latlon_srtm = [int(lr_latlon[0] + 180) / 5 + 1, int(60 - lr_latlon[1]) / 5 + 1]
-
-    for x in range(ul_latlon_srtm[0], lr_latlon_srtm[0] + 1):
-        for y in range(ul_latlon_srtm[1], lr_latlon_srtm[1] + 1):
-            liste_fic_mnt.append("srtm_%02d_%02d.tif" % (x, y))
-
-    print ul_latlon, lr_latlon
-    print ul_latlon_srtm, lr_latlon_srtm
-    print liste_fic_mnt
-
-########## MNT Planet Observer
-elif options.mnt == "PO":
-
-    ul_latlon_po = [int(floor(ul_latlon[0])), int(floor(ul_latlon[1]))]
-    lr_latlon_po = [int(floor(lr_latlon[0])), int(floor(lr_latlon[1]))]
-
-    for x in range(ul_latlon_po[0], lr_latlon_po[0] + 1):
-        for y in range(lr_latlon_po[1], ul_latlon_po[1] + 1):
-            if x >= 0:
-                ew = "e"
-                num_x = x
-            else:
-                ew = "w"
-                num_x = -x
-            if y >= 0:
-                ns = "n"
-                num_y = y
-            else:
-                ns = "s"
-                num_y = -y
-            liste_fic_mnt.append("%s%03d/%s%02d.dt1" % (ew, num_x, ns, num_y))
+# ==========liste des fichiers MNT et eau qui recouvrent les tuiles du site
+# les bords des tuiles sont densifiés puis projetés en lat/lon
+(emprises, liste_fic_mnt, liste_fic_eau, liste_centre_eau) = fichiers_site(site, rep_mnt_in, rep_swbd, options.mnt)
+lat_max = max([emprise.GetEnvelope()[3] for emprise in emprises])
 
-    print ul_latlon, lr_latlon
-    print ul_latlon_po, lr_latlon_po
-    print liste_fic_mnt
+if options.mnt == "SRTM" and lat_max > 60:
+    print "#################################################"
+    print "latitude supérieure à 60 degrés, pas de donnees SRTM"
+    print "#################################################"
+    sys.exit(-3)
 
-# liste des fichiers SWBD nécessaires
-ul_latlon_swbd = [int(floor(ul_latlon[0])), int(floor(ul_latlon[1]))]
-lr_latlon_swbd = [int(floor(lr_latlon[0])), int(floor(lr_latlon[1]))]
-print ul_latlon, lr_latlon
-print ul_latlon_swbd, lr_latlon_swbd
+print liste_fic_mnt
 
 calcul_masque_eau_mnt = 0
-if (ul_latlon[1]) > 60 or (lr_latlon[1] > 60):
+if lat_max > 60:
     print "#################################################"
     print "latitude supérieure à 60 degrés, pas de donnees SRTM"
     print "le masque d'eau est généré à partir du MNT"
     print "#################################################"
     calcul_masque_eau_mnt = 1
 
-liste_fic_eau = []
-liste_centre_eau = []
-for x in range(ul_latlon_swbd[0], lr_latlon_swbd[0] + 1):
-    for y in range(lr_latlon_swbd[1], ul_latlon_swbd[1] + 1):
-        if x >= 0:
-            ew = "e"
-            num_x = x
-        else:
-            ew = "w"
-            num_x = -x
-        if y >= 0:
-            ns = "n"
-            num_y = y
-        else:
-            ns = "s"
-            num_y = -y
-
-        liste_fic_eau.append("%s%03d%s%02d" % (ew, num_x, ns, num_y))
-        liste_centre_eau.append([x + 0.5, y + 0.5])
-
-print "longitudes", ul_latlon_swbd[0], lr_latlon_swbd[0]
-print "latitudes", lr_latlon_swbd[1], ul_latlon_swbd[1]
 print "center coordinates", liste_centre_eau
 print liste_fic_eau
 
 # Fusion des mnt_srtm en un seul
 (fic_mnt_in, fic_eau_in) = fusion_mnt(liste_fic_mnt, liste_fic_eau, liste_centre_eau, rep_mnt_in, rep_swbd, site.nom,
-                                      calcul_masque_eau_mnt)
+                                      calcul_masque_eau_mnt, vrt=options.vrt)
 print "############", fic_mnt_in
 
+####################Gradient à SRTM_RES calculé une fois pour toutes les tuiles du site
+cache_gradient = None
+if options.mode_gradient == "cache" and options.eau_seulement == False:
+    ulx_site = site.orig_x + site.tx_min * site.pas_x
+    uly_site = site.orig_y + site.ty_max * site.pas_y
+    lrx_site = site.orig_x + (site.tx_max + 1) * site.pas_x + site.marge
+    lry_site = site.orig_y + (site.ty_min - 1) * site.pas_y - site.marge
+    lrx_site = int(ceil((lrx_site - ulx_site) / float(SRTM_RES))) * SRTM_RES + ulx_site
+    lry_site = uly_site - int(ceil((uly_site - lry_site) / float(SRTM_RES))) * SRTM_RES
+    cache_gradient = classe_cache_gradient(classe_mnt(rep_mnt, site.nom, ulx_site, uly_site, lrx_site, lry_site,
+                                                      SRTM_RES, site.chaine_proj))
+
 ####################Boucle de création des fichiers MNT et eau pour chaque tuile
 
 for tx in range(site.tx_min, site.tx_max + 1):
@@ -209,27 +151,23 @@ for tx in range(site.tx_min, site.tx_max + 1):
             if not (os.path.exists(rep_mnt_out)):
                 os.mkdir(rep_mnt_out)
 
-            # Resolution SRTM_RES
             print "############### c'est parti"
-            mnt_90m = classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx_90m, lry_90m, SRTM_RES, site.chaine_proj)
-            mnt_90m.decoupe(fic_mnt_in)
-
-            # calcul du gradient à 90m
-            (fic_dz_dl_srtm, fic_dz_dc_srtm) = mnt_90m.calcul_gradient()
-
-            # Basse résolution
-
-            mnt_coarse = classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx_coarse, lry_coarse, options.COARSE_RES,
-                                    site.chaine_proj)
-            mnt_coarse.decoupe(fic_mnt_in)
-            mnt_coarse.reech_gradient(fic_dz_dl_srtm, fic_dz_dc_srtm)
-            mnt_coarse.calcul_pente_aspect_fic()
-
-            # Haute résolution
-            mnt_full = classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx, lry, options.FULL_RES, site.chaine_proj)
-            mnt_full.decoupe(fic_mnt_in)
-            mnt_full.reech_gradient(fic_dz_dl_srtm, fic_dz_dc_srtm)
-            mnt_full.calcul_pente_aspect_fic()
+            # Resolutions SRTM_RES, basse et haute résolution
+            niveaux = [classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx_90m, lry_90m, SRTM_RES, site.chaine_proj),
+                       classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx_coarse, lry_coarse, options.COARSE_RES,
+                                  site.chaine_proj),
+                       classe_mnt(rep_mnt_out, nom_tuile, ulx, uly, lrx, lry, options.FULL_RES, site.chaine_proj)]
+
+            # le mnt float et les gradients à basse résolution servent au masque d'eau au delà de 60°N
+            if options.intermediaires:
+                res_intermediaires = [mnt.res for mnt in niveaux]
+            elif calcul_masque_eau_mnt == 1:
+                res_intermediaires = [options.COARSE_RES]
+            else:
+                res_intermediaires = []
+            # une passe sur la mosaïque, gradients selon l'option -g
+            pyramide = classe_pyramide_mnt(niveaux, SRTM_RES, options.mode_gradient, cache_gradient)
+            pyramide.construit(fic_mnt_in, res_intermediaires)
 
         ### Pour l'eau
         rep_eau_out = rep_eau + nom_tuile + '/'
@@ -241,3 +179,6 @@ for tx in range(site.tx_min, site.tx_max + 1):
             eau.decoupe_eau(fic_eau_in)
         else:
             eau.calcul_masque_mnt(rep_mnt_out, nom_tuile)
+
+# les fichiers sources restent ouverts d'une tuile à l'autre
+ferme_sources()
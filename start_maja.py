@@ -26,19 +26,30 @@ License along with this program.  If not, see
 https://www.gnu.org/licenses/gpl-3.0.fr.html
 """
 
+import bisect
+import datetime
 import glob
-import tempfile
+import multiprocessing
+import threading
 import optparse
 import os
 import os.path
+import re
 import shutil
 import sys
 print sys.path
 import zipfile
 from convert_CAMS_DBL import exocam_creation
+from l1c_catalog import L1CCatalog, parse_L1C_name
+from l2_index import L2Index
+import tile_journal
+from tile_journal import TileJournal
 import logging
 
 START_MAJA_VERSION = 3.1
+ZIP_BUFFER_SIZE = 16 * 1024 * 1024  # buffer used to extract zipped L1C
+CAMS_WINDOW = 1  # days of CAMS data linked before and after each L1C date
+CAMS_PATTERN = re.compile(r".*_EXO_CAMS_(\d{8}T\d{6})_.*")
 
 # #########################################################################
 
@@ -60,18 +71,22 @@ def read_folders(fic_txt):
 
     with file(fic_txt, 'r') as f:
         for ligne in f.readlines():
-            if ligne.find('repCode') == 0:
+            # cle exacte, repCAMS ne doit pas lire la ligne repCAMS_raw
+            cle = ligne.split('=')[0].strip()
+            if cle == 'repCode':
                 repCode = (ligne.split('=')[1]).strip()
-            if ligne.find('repWork') == 0:
+            if cle == 'repWork':
                 repWork = (ligne.split('=')[1]).strip()
-            if ligne.find('repL1') == 0:
+            if cle == 'repL1':
                 repL1 = (ligne.split('=')[1]).strip()
-            if ligne.find('repL2') == 0:
+            if cle == 'repL2':
                 repL2 = (ligne.split('=')[1]).strip()
-            if ligne.find('repMaja') == 0:
+            if cle == 'repMaja':
                 repMaja = (ligne.split('=')[1]).strip()
-            if ligne.find('repCAMS') == 0:
+            if cle == 'repCAMS':
                 repCAMS = (ligne.split('=')[1]).strip()
+            if cle == 'repCAMS_raw':
+                repCAMS_raw = (ligne.split('=')[1]).strip()
 
     missing = False
 
@@ -123,7 +138,7 @@ def read_folders(fic_txt):
     if repCAMS is not None and not os.path.isdir(repCAMS):
         logger.error("repCAMS %s is missing", repCAMS)
     if repCAMS_raw is not None and not os.path.isdir(repCAMS_raw):
-        logger.error("repCAMS %s is missing", repCAMS_raw)
+        logger.error("repCAMS_raw %s is missing", repCAMS_raw)
 
     if directory_missing:
         raise Exception("One or more directories are missing. See log file for more information.")
@@ -144,7 +159,7 @@ def replace_tile_name(fic_in, fic_out, tile_in, tile_out):
                 f_out.write(l)
 
 
-def add_parameter_files(repGipp, repWorkIn, tile, repCams):
+def add_parameter_files(repGipp, repWorkIn, tile, fichiersCams):
 
     for fic in glob.glob(repGipp + "/*"):
 
@@ -156,11 +171,10 @@ def add_parameter_files(repGipp, repWorkIn, tile, repCams):
             os.symlink(fic, repWorkIn + '/' + base)
 
     # links for CAMS files
-    if repCams is not None:
-        for fic in glob.glob(os.path.join(repCams, "*")):
-            base = os.path.basename(fic)
-            #logger.debug("Linking %s in %s", fic, repWorkIn)
-            os.symlink(fic, os.path.join(repWorkIn, base))
+    for fic in fichiersCams:
+        base = os.path.basename(fic)
+        #logger.debug("Linking %s in %s", fic, repWorkIn)
+        os.symlink(fic, os.path.join(repWorkIn, base))
 
 
 def add_DEM(repDEM, repWorkIn, tile):
@@ -174,30 +188,152 @@ def add_config_files(repConf, repWorkConf):
     os.symlink(repConf, repWorkConf)
 
 
-def manage_rep_cams(repCams, repCamsRaw, working_dir):
-    if repCamsRaw is not None:
-        # convert nc to exocams
+class CAMSIndex(object):
+    """Index of the EXO_CAMS products of a directory, per acquisition date, built from one listing"""
+
+    def __init__(self, repCams):
+        fichiers_par_date = {}
         if repCams is not None:
-            logger.warning("Exo cams dir and exo cams dir all ")
-        working_directory = tempfile.mkdtemp(suffix="ConvertToExo_temp", dir=working_dir)
-        repCams_out = tempfile.mkdtemp(suffix="ConvertToExo_out", dir=working_dir)
-        exocam_creation(repCamsRaw, out_dir=repCams_out, working_dir=working_directory)
-        return repCams_out
+            for base in os.listdir(repCams):
+                m = CAMS_PATTERN.match(base)
+                if m is not None:
+                    date_cams = datetime.datetime.strptime(m.group(1), "%Y%m%dT%H%M%S")
+                    fichiers_par_date.setdefault(date_cams, []).append(os.path.join(repCams, base))
+        self.dates = sorted(fichiers_par_date.keys())
+        self.fichiers = [sorted(fichiers_par_date[date_cams]) for date_cams in self.dates]
+        logger.debug("%s CAMS dates in %s", len(self.dates), repCams)
+
+    def select(self, dates, window=CAMS_WINDOW):
+        """Returns the CAMS files acquired less than window days before or after the day of one of the L1C dates"""
+        selection = []
+        indices = set()
+        for d in dates:
+            # the L1C dates have no time : the window is symmetric around the whole acquisition day,
+            # from its start minus window days to its end (start + 1 day) plus window days, end excluded
+            debut_jour = datetime.datetime.strptime(d, "%Y%m%d")
+            fin_jour = debut_jour + datetime.timedelta(days=1)
+            debut = bisect.bisect_left(self.dates, debut_jour - datetime.timedelta(days=window))
+            fin = bisect.bisect_left(self.dates, fin_jour + datetime.timedelta(days=window))
+            indices.update(range(debut, fin))
+        for i in sorted(indices):
+            selection.extend(self.fichiers[i])
+        return selection
+
+
+def manage_rep_cams(repCams, repCamsRaw, working_dir, nb_procs=multiprocessing.cpu_count(), convert=True):
+    """Returns the directory of the EXO_CAMS files
+    if convert is False, the netCDF files of repCamsRaw are supposed to be already converted (by the parent of the
+    parallel jobs), and only the directory is returned
+    """
+    if repCamsRaw is not None:
+        # convert nc to exocams, in a persistent directory where only new dates are converted
+        if repCams is None:
+            repCams = os.path.join(working_dir, "CAMS_cache")
+        if convert:
+            if not os.path.exists(repCams):
+                os.makedirs(repCams)
+            exocam_creation(repCamsRaw, out_dir=repCams, working_dir=repCams, nb_procs=nb_procs)
 
     return repCams
 
 
-def unzipAndMoveL1C(L1Czipped, workdir, tile):
-    # unzip L1C file
+def extract_L1C_tile(L1Czipped, cacheDir, tile):
+    """Extracts from a zipped L1C the granule of the tile and the product metadata, into cacheDir
+    members are streamed with large buffers, and an already extracted product is reused
+    returns the path of the extracted SAFE
+    """
+    with zipfile.ZipFile(L1Czipped, 'r') as zip_ref:
+        safeDir = zip_ref.namelist()[0].split('/')[0]
+        safePath = os.path.join(cacheDir, safeDir)
+        # the marker is written once the extraction is complete
+        marker = safePath + ".extracted"
+        if os.path.exists(marker):
+            logger.debug("L1C %s already extracted in %s", L1Czipped, cacheDir)
+            return safePath
+        if os.path.exists(safePath):
+            shutil.rmtree(safePath)
+
+        for member in zip_ref.infolist():
+            parts = member.filename.split('/')
+            if member.filename.startswith('/') or '..' in parts:
+                logger.warning("Skipping suspicious member %s of %s", member.filename, L1Czipped)
+                continue
+            # other granules of old multi-tile products are not needed
+            if len(parts) > 2 and parts[1] == "GRANULE" and parts[2] != "" and parts[2].find(tile) < 0:
+                continue
+            destination = os.path.join(cacheDir, member.filename)
+            if member.filename.endswith('/'):
+                if not os.path.exists(destination):
+                    os.makedirs(destination)
+                continue
+            if not os.path.exists(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            with zip_ref.open(member) as src:
+                with open(destination, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, ZIP_BUFFER_SIZE)
+        open(marker, 'w').close()
+    return safePath
+
+
+def unzipAndMoveL1C(L1Czipped, workdir, tile, cacheDir):
+    # unzip L1C file in the cache, and link it in the working directory
     try:
-        with zipfile.ZipFile(L1Czipped, 'r') as zip_ref:
-            safeDir=zip_ref.namelist()[0]
-            zip_ref.extractall(workdir)
-    except IOError:
-        print("L1C zip file %s is not readable"% L1Czipped)
+        safePath = extract_L1C_tile(L1Czipped, cacheDir, tile)
+    except (IOError, zipfile.BadZipfile):
+        print("L1C zip file %s is not readable" % L1Czipped)
         sys.exit(-1)
+    os.symlink(safePath, os.path.join(workdir, os.path.basename(safePath)))
+
+    return safePath
+
+
+def purge_L1C_cache(safe_par_date, dates):
+    # removes the extracted L1C of dates which are already processed
+    for d in dates:
+        safePath = safe_par_date.pop(d, None)
+        if safePath is not None and os.path.exists(safePath):
+            logger.debug("Removing %s from L1C cache", safePath)
+            shutil.rmtree(safePath)
+            os.remove(safePath + ".extracted")
+
+
+def stage_inputs(repIn, dates, prod_par_dateImg, zipped, tile, repCache, repGipp, repDtm, cams_index, safe_par_date):
+    """Prepares the input directory of a MAJA execution, for the L1C of the given dates
+    the previous L2 product is not linked, as it depends on the previous MAJA execution
+    """
+    if os.path.exists(repIn):
+        shutil.rmtree(repIn)
+    os.makedirs(repIn)
+    for d in dates:
+        if zipped:
+            safe_par_date[d] = unzipAndMoveL1C(prod_par_dateImg[d], repIn, tile, repCache)
+        else:
+            os.symlink(prod_par_dateImg[d], os.path.join(repIn, os.path.basename(prod_par_dateImg[d])))
+    # only the CAMS around the L1C dates are needed
+    add_parameter_files(repGipp, repIn + "/", tile, cams_index.select(dates))
+    add_DEM(repDtm, repIn + "/", tile)
 
-    return
+
+class StagingThread(threading.Thread):
+    """Prepares in background the input directory of the next MAJA execution"""
+
+    def __init__(self, *args):
+        threading.Thread.__init__(self)
+        self.args_staging = args
+        self.error = None
+
+    def run(self):
+        try:
+            stage_inputs(*self.args_staging)
+        except BaseException as e:
+            # also catches the sys.exit of unzipAndMoveL1C, to stop the main thread in wait()
+            logger.error("Error while preparing %s : %s", self.args_staging[0], e)
+            self.error = e
+
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
 
 
 def test_valid_L2A(L2A_DIR):
@@ -229,44 +365,48 @@ def test_valid_L2A(L2A_DIR):
     return(valid)
 
 
-def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, debug_mode):
-    # =================directories
-    (repCode, repWork, repL1, repL2, maja, repCams, repCamsRaw) = read_folders(folder_file)
-
-    repCams = manage_rep_cams(repCams, repCamsRaw, repWork)
-
-    repConf = repCode + "/userconf"
-    if not(os.path.exists(repConf)):
-        logger.error("Config dir %s does not exist", repConf)
-        sys.exit(-1)
-    repDtm = repCode + "/DTM"
-    if not(os.path.exists(repDtm)):
-        logger.error("DTM dir %s does not exist", repDtm)
-        sys.exit(-1)
-    repGipp = repCode + "/GIPP_%s" % context
-    if not(os.path.exists(repGipp)):
-        logger.error("GIPP dir %s does not exist", repGipp)
-        sys.exit(-1)
-
-    repWork = "%s/%s/%s/%s/" % (repWork, site, tile, context)
-    if not (os.path.exists(repWork)):
-        try:
-            os.makedirs(repWork)
-        except:
-            logger.error("something wrong when creating %s", repWork)
-            sys.exit(-1)
-    repL1 = "%s/%s/" % (repL1, site)
-    repL2 = "%s/%s/%s/%s/" % (repL2, site, tile, context)
+def check_L2_product(repL2, tile, d, index_L2):
+    """Records the L2A product issued by MAJA for date d in the L2 index
+    returns the state of the date for the journal, and the type of the product (None if no product was found)"""
+    nomL2init_Natif = glob.glob("%s/S2?_OPER_SSC_L2VALD_%s____%s.DBL.DIR" % (repL2, tile, d))
+    nomL2init_MUSCATE = glob.glob("%s/SENTINEL2?_%s-*_T%s_C_V*" % (repL2, d, tile))
+    etat = tile_journal.L2NOTV
+    L2type = None
+    if len(nomL2init_Natif) > 0:
+        L2type = "Natif"
+        index_L2.record(d, L2type, nomL2init_Natif[0], True)
+        etat = tile_journal.VALID
+    elif len(nomL2init_MUSCATE) > 0:
+        L2type = "MUSCATE"
+        # test if L2A products is valid
+        valid = test_valid_L2A(nomL2init_MUSCATE[0])
+        if valid:
+            index_L2.record(d, L2type, nomL2init_MUSCATE[0], True)
+            etat = tile_journal.VALID
+        else:
+            nomL2NOTV = os.path.join(os.path.dirname(nomL2init_MUSCATE[0]),
+                                     "L2NOTV_" + os.path.basename(nomL2init_MUSCATE[0]))
+            index_L2.record(d, L2type, nomL2NOTV, False)
+    return etat, L2type
+
+
+def clean_L2_outputs(repL2, tile, d):
+    # removes the L2A products of date d, valid or not, whatever their format
+    for pattern in ["S2?_OPER_SSC_L2*_%s____%s.*" % (tile, d),
+                    "SENTINEL2?_%s-*_T%s_C_V*" % (d, tile),
+                    "L2NOTV_SENTINEL2?_%s-*_T%s_C_V*" % (d, tile)]:
+        for fic in glob.glob(os.path.join(repL2, pattern)):
+            logger.info("Removing %s", fic)
+            if os.path.isdir(fic) and not os.path.islink(fic):
+                shutil.rmtree(fic)
+            else:
+                os.remove(fic)
 
-    # check existence of folders
-    for fic in repL1, repCode, repWork, maja:
-        if not (os.path.exists(fic)):
-            logger.error("ERROR : %s does not exist", fic)
-            sys.exit(-1)
-
-    if not os.path.exists(repL2):
-        os.makedirs(repL2)
 
+def list_L1C_products(repL1, tile, orbit, options):
+    """Returns a dictionary {acquisition date : L1C product} from a scan of repL1
+    when several products exist for the same date, the one with the most recent production date is kept
+    """
     if options.zip:
         if orbit is not None:
             listeProd = glob.glob(repL1 + "/S2?_MSIL1C*%s_T%s*.zip" % (orbit, tile))
@@ -281,10 +421,6 @@ def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, de
         listeProd = listeProd + glob.glob(repL1 + "/S2?_MSIL1C*.SAFE/GRANULE/*%s*" % (tile))
 
     logger.debug("Liste prod %s", listeProd)
-    # list of images to process
-    dateProd = []
-    dateImg = []
-    listeProdFiltree = []
 
     if len(listeProd) == 0:
         if options.zip:
@@ -301,58 +437,83 @@ def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, de
                          repL1 + "/S2?_MSIL1C*.SAFE/GRANULE/*%s*" % (tile))
         sys.exit(-3)
 
+    # list of images to process, removing multiple images with same date and tile
+    prod_par_dateImg = {}
+    dateProd_par_dateImg = {}
     for elem in listeProd:
-        if options.zip:
-            rac = elem.split("/")[-1]
-        else:
-            rac = elem.split("/")[-3]
+        if not options.zip:
             elem = '/'.join(elem.split("/")[0:-2])
         logger.debug("elem: %s", elem)
         rac = os.path.basename(elem)
         logger.debug("rac: %s", rac)
 
-        if rac.startswith("S2A_OPER_PRD_MSIL1C") or rac.startswith("S2B_OPER_PRD_MSIL1C"):
-            date_asc = rac.split('_')[7][1:9]
-        else:
-            date_asc = rac.split('_')[2][0:8]
+        (date_asc, date_prod, orbit_prod) = parse_L1C_name(rac)
         logger.debug("date_asc %s %s %s/%s", date_asc, date_asc >=
                      options.startDate, date_asc, options.startDate)
         if date_asc >= options.startDate and date_asc <= options.endDate:
-            dateImg.append(date_asc)
-            if rac.startswith("S2A_OPER_PRD_MSIL1C") or rac.startswith("S2B_OPER_PRD_MSIL1C"):
-                dateProd.append(rac.split('_')[5])
-            else:
-                dateProd.append(rac.split('_')[6])
-            listeProdFiltree.append(elem)
+            # keep only the products with the most recent production date
+            if date_prod > dateProd_par_dateImg.get(date_asc, ""):
+                dateProd_par_dateImg[date_asc] = date_prod
+                prod_par_dateImg[date_asc] = elem
 
-    # removing multiple images with same date and tile
-    logger.debug("date img %s", dateImg)
-    logger.debug("set %s", set(dateImg))
+    logger.debug("date prod %s", dateProd_par_dateImg)
+    return prod_par_dateImg
 
-    dates_diff = list(set(dateImg))
-    dates_diff.sort()
 
-    prod_par_dateImg = {}
-    nomL2_par_dateImg_Natif = {}
-    nomL2_par_dateImg_MUSCATE = {}
+def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, debug_mode, convert_cams=True):
+    # =================directories
+    (repCode, repWork, repL1, repL2, maja, repCams, repCamsRaw) = read_folders(folder_file)
+
+    repCams = manage_rep_cams(repCams, repCamsRaw, repWork, convert=convert_cams)
+    cams_index = CAMSIndex(repCams)
+
+    repConf = repCode + "/userconf"
+    if not(os.path.exists(repConf)):
+        logger.error("Config dir %s does not exist", repConf)
+        sys.exit(-1)
+    repDtm = repCode + "/DTM"
+    if not(os.path.exists(repDtm)):
+        logger.error("DTM dir %s does not exist", repDtm)
+        sys.exit(-1)
+    repGipp = repCode + "/GIPP_%s" % context
+    if not(os.path.exists(repGipp)):
+        logger.error("GIPP dir %s does not exist", repGipp)
+        sys.exit(-1)
+
+    repWork_root = repWork
+    repWork = "%s/%s/%s/%s/" % (repWork, site, tile, context)
+    if not (os.path.exists(repWork)):
+        try:
+            os.makedirs(repWork)
+        except:
+            logger.error("something wrong when creating %s", repWork)
+            sys.exit(-1)
+    repL1 = "%s/%s/" % (repL1, site)
+    repL2 = "%s/%s/%s/%s/" % (repL2, site, tile, context)
+
+    # check existence of folders
+    for fic in repL1, repCode, repWork, maja:
+        if not (os.path.exists(fic)):
+            logger.error("ERROR : %s does not exist", fic)
+            sys.exit(-1)
+
+    if not os.path.exists(repL2):
+        os.makedirs(repL2)
+
+    if getattr(options, "catalog", False):
+        catalog = L1CCatalog(os.path.join(repWork_root, site, "L1C_catalog.sqlite"))
+        catalog.update(repL1)
+        prod_par_dateImg = catalog.select(tile, orbit, options.zip, options.startDate, options.endDate)
+        catalog.close()
+        if len(prod_par_dateImg) == 0:
+            logger.error("No L1C product found in catalog of %s for tile %s", repL1, tile)
+            sys.exit(-3)
+    else:
+        prod_par_dateImg = list_L1C_products(repL1, tile, orbit, options)
+
+    dates_diff = sorted(prod_par_dateImg.keys())
+
     for d in dates_diff:
-        nb = dateImg.count(d)
-
-        dpmax = ""
-        ind = -1
-        # search the most recent production date
-        for i in range(0, nb):
-            ind = dateImg.index(d, ind + 1)
-            dp = dateProd[ind]
-            if dp > dpmax:
-                dpmax = dp
-
-        # keep only the products with the most recent date
-        ind = dateProd.index(dpmax)
-        logger.debug("date prod max %s index in list %s", dpmax, ind)
-        prod_par_dateImg[d] = listeProdFiltree[ind]
-        nomL2_par_dateImg_Natif[d] = "S2?_OPER_SSC_L2VALD_%s____%s.DBL.DIR" % (tile, d)
-        nomL2_par_dateImg_MUSCATE[d] = "SENTINEL2?_%s-*_T%s_C_V*" % (d, tile)
         logger.debug("d %s, prod_par_dateImg[d] %s", d, prod_par_dateImg[d])
 
     print
@@ -360,24 +521,25 @@ def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, de
 
     logger.debug("dates_diff %s", dates_diff)
 
-    derniereDate = ""
-    for d in dates_diff:
-        logger.debug("d %s", d)
-        logger.debug("%s/%s", repL2, nomL2_par_dateImg_Natif[d])
-        logger.debug("%s/%s", repL2, nomL2_par_dateImg_MUSCATE[d])
-        #logger.debug(glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_Natif[d])))
-        #logger.debug(glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_MUSCATE[d])))
-
-        # test existence of a L2 with MAJA name convention
-        nomL2init_Natif = glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_Natif[d]))
-        nomL2init_MUSCATE = glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_MUSCATE[d]))
-        if len(nomL2init_Natif) > 0:
-            derniereDate = d
-            L2type = "Natif"
-
-        elif len(nomL2init_MUSCATE) > 0:
-            L2type = "MUSCATE"
-            derniereDate = d
+    index_L2 = L2Index(repL2, tile)
+    journal = TileJournal(repL2)
+    # half-written outputs of MAJA executions interrupted by a crash, or which failed
+    for d in journal.interrupted():
+        logger.warning("Processing of %s was interrupted or failed, removing its outputs", d)
+        clean_L2_outputs(repL2, tile, d)
+        index_L2.remove(d)
+        journal.record(d, tile_journal.ABORTED)
+    # MAJA executions which completed, but were interrupted before the check of their product
+    for d in journal.finished():
+        logger.warning("Processing of %s finished without being checked, checking its product", d)
+        (etat, L2type_produit) = check_L2_product(repL2, tile, d, index_L2)
+        journal.record(d, etat)
+
+    derniereDate = index_L2.last_date(dates_diff)
+    if derniereDate != "":
+        L2type = index_L2.get(derniereDate)["type"]
+        # dates already processed after the last valid L2A, without issuing a valid product
+        derniereDate = max(derniereDate, journal.last_completed(dates_diff))
 
     if derniereDate == "":
         logger.info("No existing L2 product, we start with backward mode")
@@ -401,114 +563,227 @@ def start_maja(folder_file, context, site, tile, orbit, nb_backward, options, de
         #logger.debug("create %s userconf %s", repWork)
         add_config_files(repConf, repWork + "userconf")
 
+    # extracted L1C are kept in a cache, to be reused by the following MAJA executions
+    repCache = repWork + "L1C_cache"
+    if options.zip and not os.path.exists(repCache):
+        os.makedirs(repCache)
+    safe_par_date = {}
+
     logger.debug("derniereDate %s", derniereDate)
-    for i in range(nb_dates):
+    # only products after the last L2A date available in output directory
+    indices_a_traiter = [i for i in range(nb_dates) if dates_diff[i] > derniereDate]
+    nb_prod_backward = min(len(dates_diff), nb_backward)
+
+    def dates_L1C(i):
+        # Mode Backward, if it is the first date in the list
+        if i == 0:
+            return dates_diff[0:nb_prod_backward]
+        return [dates_diff[i]]
+
+    # input directories left by an interrupted run
+    for repIn in glob.glob(repWork + "in_*"):
+        shutil.rmtree(repIn)
+
+    staging = None
+    for (k, i) in enumerate(indices_a_traiter):
         d = dates_diff[i]
-        # only products after the last L2A date available in output directory
-        if d > derniereDate:
-            logger.info("=> processing date %s" % d)
-            if os.path.exists(repWork + "/in"):
-                shutil.rmtree(repWork + "/in")
-            os.makedirs(repWork + "/in")
-            # Mode Backward, if it is the first date in the list
-            if i == 0:
-                nb_prod_backward = min(len(dates_diff), nb_backward)
-                logger.info("dates to process in backward mode :")
-                for date_backward in dates_diff[0:nb_prod_backward]:
-                    logger.info("-- %s : %s" % (date_backward, prod_par_dateImg[date_backward]))
-                    if options.zip:
-                        unzipAndMoveL1C(prod_par_dateImg[date_backward], repWork + "/in/", tile)
-                    else:
-                        os.symlink(prod_par_dateImg[date_backward],
-                                   repWork + "/in/" + os.path.basename(prod_par_dateImg[date_backward]))
-                add_parameter_files(repGipp, repWork + "/in/", tile, repCams)
-                add_DEM(repDtm, repWork + "/in/", tile)
-
-                Maja_logfile = "%s/%s.log" % (repL2, os.path.basename(prod_par_dateImg[d]))
-                logger.debug(os.listdir(os.path.join(repWork, "in")))
-                commande = "%s %s -i %s -o %s -m L2BACKWARD -ucs %s --TileId %s &> %s" % (
-                    maja, debug_option, repWork + "/in", repL2, repWork + "/userconf", tile, Maja_logfile)
-                logger.info("#################################")
-                logger.info("#################################")
-                logger.info("processing %s in backward mode" % prod_par_dateImg[d])
-                logger.info("Initialisation mode with backward is longer")
-                logger.info("MAJA logfile: %s", Maja_logfile)
-                logger.info("#################################")
-                os.system(commande)
-
-            # else mode nominal
-            else:
-                nomL2 = ""
-                # Search for previous L2 product
-                logger.info("Using %s L2 type" % L2type)
-                for PreviousDate in dates_diff[0:i]:
-                    if L2type == "Natif":
-                        nom_courant = "%s/%s" % (repL2, nomL2_par_dateImg_Natif[PreviousDate])
-                    elif L2type == "MUSCATE":
-                        nom_courant = "%s/%s" % (repL2, nomL2_par_dateImg_MUSCATE[PreviousDate])
-                    try:
-                        logger.debug(nom_courant)
-                        nomL2 = glob.glob(nom_courant)[0]
-                        logger.debug("Previous L2 names, per increasing date : %s", nomL2)
-                    except:
-                        logger.debug("pas de L2 pour : %s", nom_courant)
-                        pass
-                logger.info("previous L2 : %s", nomL2)
-                # copy (or symlink) L1C
-                if options.zip:
-                    unzipAndMoveL1C(prod_par_dateImg[d], repWork + "/in/", tile)
-                else:
-                    os.symlink(prod_par_dateImg[d],
-                               repWork + "/in/" + os.path.basename(prod_par_dateImg[d]))
-                # find type of L2A
-                if L2type == "Natif":
-                    os.symlink(nomL2, repWork + "/in/" + os.path.basename(nomL2))
-                    os.symlink(nomL2.replace("DBL.DIR", "HDR"),
-                               repWork + "/in/" + os.path.basename(nomL2).replace("DBL.DIR", "HDR"))
-                    os.symlink(nomL2.replace("DIR", ""), repWork + "/in/" +
-                               os.path.basename(nomL2).replace("DIR", ""))
-                elif L2type == "MUSCATE":
-                    os.symlink(nomL2, repWork + "/in/" + os.path.basename(nomL2))
-
-                Maja_logfile = "%s/%s.log" % (repL2, os.path.basename(prod_par_dateImg[d]))
-
-                add_parameter_files(repGipp, repWork + "/in/", tile, repCams)
-                add_DEM(repDtm, repWork + "/in/", tile)
-
-                logger.debug(os.listdir(os.path.join(repWork, "in")))
-
-                commande = "%s %s -i %s -o %s -m L2NOMINAL -ucs %s --TileId %s &> %s" % (
-                    maja, debug_option, repWork + "/in", repL2, repWork + "/userconf", tile, Maja_logfile)
-                logger.info("#################################")
-                logger.info("#################################")
-                logger.info("processing %s in nominal mode" % prod_par_dateImg[d])
-                logger.info("MAJA logfile: %s", Maja_logfile)
-                logger.info("#################################")
-                os.system(commande)
-
-            # check for errors in MAJA executions
-            nomL2init_Natif = glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_Natif[d]))
-            nomL2init_MUSCATE = glob.glob("%s/%s" % (repL2, nomL2_par_dateImg_MUSCATE[d]))
-            if len(nomL2init_Natif) > 0:
-                L2type = "Natif"
-            elif len(nomL2init_MUSCATE) > 0:
-                L2type = "MUSCATE"
-                # test if L2A products is valid
-                valid = test_valid_L2A(nomL2init_MUSCATE[0])
-
-            # check for errors in MAJA executions
-
-            Error = False
-            with open(Maja_logfile, "r") as logfile:
-                for line in logfile:
-                    if line.find("[E]") > 0:
-                        print line
-                        Error = True
-            if Error:
-                logger.info("#######################################")
-                logger.info("Error detected, see: %s" % Maja_logfile)
-                logger.info("#######################################")
+        logger.info("=> processing date %s" % d)
+        repIn = repWork + "in_" + d
+        if staging is None:
+            staging = StagingThread(repIn, dates_L1C(i), prod_par_dateImg, options.zip, tile, repCache,
+                                    repGipp, repDtm, cams_index, safe_par_date)
+            staging.start()
+        staging.wait()
+        journal.record(d, tile_journal.STAGED)
+
+        if i == 0:
+            logger.info("dates to process in backward mode :")
+            for date_backward in dates_L1C(i):
+                logger.info("-- %s : %s" % (date_backward, prod_par_dateImg[date_backward]))
+
+            Maja_logfile = "%s/%s.log" % (repL2, os.path.basename(prod_par_dateImg[d]))
+            logger.debug(os.listdir(repIn))
+            commande = "%s %s -i %s -o %s -m L2BACKWARD -ucs %s --TileId %s &> %s" % (
+                maja, debug_option, repIn, repL2, repWork + "/userconf", tile, Maja_logfile)
+            logger.info("#################################")
+            logger.info("#################################")
+            logger.info("processing %s in backward mode" % prod_par_dateImg[d])
+            logger.info("Initialisation mode with backward is longer")
+            logger.info("MAJA logfile: %s", Maja_logfile)
+            logger.info("#################################")
+
+        # else mode nominal
+        else:
+            # Search for previous L2 product, which is only known once the previous execution is finished
+            logger.info("Using %s L2 type" % L2type)
+            nomL2 = index_L2.previous(d, L2type, dates_diff[0])
+            logger.info("previous L2 : %s", nomL2)
+            # find type of L2A
+            if L2type == "Natif":
+                os.symlink(nomL2, repIn + "/" + os.path.basename(nomL2))
+                os.symlink(nomL2.replace("DBL.DIR", "HDR"),
+                           repIn + "/" + os.path.basename(nomL2).replace("DBL.DIR", "HDR"))
+                os.symlink(nomL2.replace("DIR", ""), repIn + "/" +
+                           os.path.basename(nomL2).replace("DIR", ""))
+            elif L2type == "MUSCATE":
+                os.symlink(nomL2, repIn + "/" + os.path.basename(nomL2))
+
+            Maja_logfile = "%s/%s.log" % (repL2, os.path.basename(prod_par_dateImg[d]))
+
+            logger.debug(os.listdir(repIn))
+
+            commande = "%s %s -i %s -o %s -m L2NOMINAL -ucs %s --TileId %s &> %s" % (
+                maja, debug_option, repIn, repL2, repWork + "/userconf", tile, Maja_logfile)
+            logger.info("#################################")
+            logger.info("#################################")
+            logger.info("processing %s in nominal mode" % prod_par_dateImg[d])
+            logger.info("MAJA logfile: %s", Maja_logfile)
+            logger.info("#################################")
+
+        # the inputs of the next date are prepared while MAJA is running
+        staging = None
+        if k + 1 < len(indices_a_traiter):
+            i_suivant = indices_a_traiter[k + 1]
+            staging = StagingThread(repWork + "in_" + dates_diff[i_suivant], dates_L1C(i_suivant),
+                                    prod_par_dateImg, options.zip, tile, repCache,
+                                    repGipp, repDtm, cams_index, safe_par_date)
+            staging.start()
+        journal.record(d, tile_journal.STARTED, log=Maja_logfile)
+        os.system(commande)
+        journal.record(d, tile_journal.FINISHED)
+        shutil.rmtree(repIn)
+        purge_L1C_cache(safe_par_date, dates_diff[0:i + 1])
+
+        # check for errors in MAJA executions
+        (etat, L2type_produit) = check_L2_product(repL2, tile, d, index_L2)
+        if L2type_produit is not None:
+            L2type = L2type_produit
+
+        # check for errors in MAJA executions
+
+        Error = False
+        with open(Maja_logfile, "r") as logfile:
+            for line in logfile:
+                if line.find("[E]") > 0:
+                    print line
+                    Error = True
+        if Error:
+            # the outputs of a failed execution are removed at the next start
+            index_L2.remove(d)
+            journal.record(d, tile_journal.ERROR, log=Maja_logfile)
+            logger.info("#######################################")
+            logger.info("Error detected, see: %s" % Maja_logfile)
+            logger.info("#######################################")
+            if staging is not None:
+                staging.join()
+            sys.exit(-1)
+        journal.record(d, etat)
+
+
+# =============== Multi-tile scheduler
+
+def read_jobs(fic_jobs):
+    """Reads a job file : one job per line, "site tile [orbit] [context]"
+    orbit may be replaced by "-" to process all orbits. Lines starting with # are ignored
+    """
+    jobs = []
+    with file(fic_jobs, 'r') as f:
+        for ligne in f.readlines():
+            champs = ligne.split()
+            if len(champs) == 0 or champs[0].startswith('#'):
+                continue
+            if len(champs) < 2:
+                logger.error("Incorrect job line in %s : %s", fic_jobs, ligne.strip())
                 sys.exit(-1)
+            site = champs[0]
+            tile = champs[1]
+            orbit = None
+            context = None
+            if len(champs) > 2 and champs[2] != "-":
+                orbit = champs[2]
+            if len(champs) > 3:
+                context = champs[3]
+            jobs.append((site, tile, orbit, context))
+    return jobs
+
+
+def compute_nb_parallel_jobs(cpu_per_job, ram_per_job, max_jobs=None):
+    """Number of tiles which may run at the same time without oversubscribing the node
+    cpu_per_job : number of cores used by one MAJA run
+    ram_per_job : memory (MB) used by one MAJA run
+    """
+    nb_cpu = multiprocessing.cpu_count()
+    try:
+        ram_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        ram_mb = None
+
+    nb_jobs = max(1, nb_cpu // cpu_per_job)
+    if ram_mb is not None:
+        nb_jobs = min(nb_jobs, max(1, ram_mb // ram_per_job))
+    if max_jobs is not None:
+        nb_jobs = min(nb_jobs, max_jobs)
+    logger.info("%s cpus, %s MB of memory : %s parallel jobs", nb_cpu, ram_mb, nb_jobs)
+    return int(nb_jobs)
+
+
+def init_job_budget(cpu_per_job, ram_per_job):
+    # MAJA is based on OTB/ITK, which read these variables to limit threads and memory
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(cpu_per_job)
+    os.environ["OTB_MAX_RAM_HINT"] = str(ram_per_job)
+
+
+def start_maja_job(job):
+    """Processes the time series of one tile, within a worker of the pool
+    backward and nominal modes are kept in chronological order inside the tile
+    the CAMS files are already converted by start_maja_jobs
+    """
+    (folder_file, context, site, tile, orbit, nb_backward, options, debug_mode) = job
+    try:
+        start_maja(folder_file, context, site, tile, orbit, nb_backward, options, debug_mode, convert_cams=False)
+        status = 0
+    except SystemExit as e:
+        status = e.code
+    except Exception:
+        logger.exception("Unexpected error while processing %s %s", site, tile)
+        status = -1
+    return (site, tile, context, status)
+
+
+def start_maja_jobs(folder_file, jobs, nb_backward, options, debug_mode):
+    """Runs independent tiles at the same time on a bounded process pool
+    each tile keeps its own repWork/site/tile/context directory
+    """
+    nb_jobs = compute_nb_parallel_jobs(options.cpu_per_job, options.ram_per_job, options.max_jobs)
+
+    # the CAMS files shared by the tiles are converted once, on all the cores, before the jobs start
+    (repCode, repWork, repL1, repL2, maja, repCams, repCamsRaw) = read_folders(folder_file)
+    manage_rep_cams(repCams, repCamsRaw, repWork)
+
+    liste_jobs = []
+    for (site, tile, orbit, context) in jobs:
+        if context is None:
+            context = options.context
+        liste_jobs.append((folder_file, context, site, tile, orbit, nb_backward, options, debug_mode))
+
+    pool = multiprocessing.Pool(nb_jobs, init_job_budget, (options.cpu_per_job, options.ram_per_job))
+    failed = []
+    try:
+        for (site, tile, context, status) in pool.imap_unordered(start_maja_job, liste_jobs):
+            if status:
+                logger.error("Processing of %s %s (%s) failed with status %s", site, tile, context, status)
+                failed.append((site, tile, context))
+            else:
+                logger.info("Processing of %s %s (%s) done", site, tile, context)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    logger.info("%s/%s jobs succeeded", len(liste_jobs) - len(failed), len(liste_jobs))
+    return failed
 
 
 if __name__ == '__main__':
@@ -550,12 +825,28 @@ if __name__ == '__main__':
         parser.add_option("-z", "--zip", dest="zip", action="store_true",
                           help="input L1C are zip files", default=False)
 
+        parser.add_option("--catalog", dest="catalog", action="store_true",
+                          help="use a persistent catalog of L1C products instead of scanning repL1", default=False)
+
         parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
                           help="Will provide verbose start_maja logs", default=False)
 
         parser.add_option("--debug", dest="debug", action="store_true",
                           help="Use MAJA Debug mode to get verbose logs", default=False)
 
+        parser.add_option("-j", "--jobs", dest="job_file", action="store", type="string",
+                          help="file listing the tiles to process in parallel, one 'site tile [orbit] [context]' per line",
+                          default=None)
+
+        parser.add_option("--cpu_per_job", dest="cpu_per_job", action="store", type="int",
+                          help="number of cores used by each parallel job (optional)", default=4)
+
+        parser.add_option("--ram_per_job", dest="ram_per_job", action="store", type="int",
+                          help="memory in MB used by each parallel job (optional)", default=8192)
+
+        parser.add_option("--max_jobs", dest="max_jobs", action="store", type="int",
+                          help="maximum number of parallel jobs (optional)", default=None)
+
         (options, args) = parser.parse_args()
 
     # Logfile configuration
@@ -582,4 +873,10 @@ if __name__ == '__main__':
 
     nb_backward = 8  # number of images to process in backward mode
 
-    start_maja(folder_file, context, site, tile, orbit, nb_backward, options, debug_mode)
+    if options.job_file is not None:
+        jobs = read_jobs(options.job_file)
+        failed = start_maja_jobs(folder_file, jobs, nb_backward, options, debug_mode)
+        if failed:
+            sys.exit(-1)
+    else:
+        start_maja(folder_file, context, site, tile, orbit, nb_backward, options, debug_mode)
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Processing journal of a tile, used by start_maja.py to resume an interrupted time series.
+
+For each date, the journal records the successive states of the processing : staged, started, finished,
+then valid or L2NOTV, or error. One JSON record is appended per line and flushed to disk, so that the journal
+remains readable after a crash, and can be read by other tools to follow the progress of a tile.
+
+==================== Copyright
+Software (tile_journal.py)
+
+Copyright© 2018 Centre National d’Etudes Spatiales
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3
+as published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this program.  If not, see
+https://www.gnu.org/licenses/gpl-3.0.fr.html
+"""
+
+import datetime
+import json
+import os
+import os.path
+
+import logging
+logger = logging.getLogger('Start-Maja')
+
+JOURNAL_FILE = "start_maja_journal.txt"
+
+STAGED = "staged"
+STARTED = "started"
+FINISHED = "finished"
+VALID = "valid"
+L2NOTV = "L2NOTV"
+ERROR = "error"
+ABORTED = "aborted"
+
+# states after which a date does not need to be processed again
+COMPLETED = (VALID, L2NOTV)
+
+
+def read_journal(fichier):
+    """Returns the last state of each date recorded in a journal file"""
+    etats = {}
+    if not os.path.exists(fichier):
+        return etats
+    with open(fichier) as f:
+        for ligne in f:
+            try:
+                enregistrement = json.loads(ligne)
+            except ValueError:
+                # last line of a journal interrupted while writing
+                continue
+            etats[str(enregistrement["date"])] = str(enregistrement["state"])
+    return etats
+
+
+def journal_summary(fichier):
+    """Returns the number of dates per state, and the last completed date of a journal file"""
+    etats = read_journal(fichier)
+    nb_par_etat = {}
+    for etat in etats.values():
+        nb_par_etat[etat] = nb_par_etat.get(etat, 0) + 1
+    completes = [d for (d, etat) in etats.items() if etat in COMPLETED]
+    derniere = max(completes) if completes else ""
+    return nb_par_etat, derniere
+
+
+class TileJournal(object):
+
+    def __init__(self, repL2):
+        self.fichier = os.path.join(repL2, JOURNAL_FILE)
+        self.etats = read_journal(self.fichier)
+
+    def record(self, d, etat, **infos):
+        enregistrement = {"date": d, "state": etat, "time": datetime.datetime.utcnow().isoformat()}
+        enregistrement.update(infos)
+        with open(self.fichier, "a") as f:
+            f.write(json.dumps(enregistrement, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.etats[d] = etat
+
+    def state(self, d):
+        return self.etats.get(d)
+
+    def last_completed(self, dates):
+        """Returns the most recent date of the list which was completely processed, or an empty string"""
+        derniereDate = ""
+        for d in dates:
+            if d > derniereDate and self.etats.get(d) in COMPLETED:
+                derniereDate = d
+        return derniereDate
+
+    def interrupted(self):
+        """Returns the dates for which MAJA was started but did not finish, or ended with an error"""
+        return sorted([d for (d, etat) in self.etats.items() if etat in (STARTED, ERROR)])
+
+    def finished(self):
+        """Returns the dates for which MAJA finished, but whose product was not checked"""
+        return sorted([d for (d, etat) in self.etats.items() if etat == FINISHED])